@@ -0,0 +1,99 @@
+# -*- encoding: utf-8 -*-
+
+"""Admission control
+
+Requests are sorted into classes by cost, eg. id lookups, searches and
+full-text searches.  Each class may have
+
+- a limit on the requests running at once.  Requests over the limit are
+  rejected at once, so that a flood of expensive queries cannot tie up all
+  database connections while the cheap requests wait.
+
+- a rate limit per client, as a token bucket: a client may send burst requests
+  at once, then rate requests per second.
+
+Both are kept per process.  With N worker processes a client may send N times
+the rate, and a limit on the requests running at once only bites if a process
+serves requests in parallel, eg. under ASGI or a threaded WSGI server.
+
+"""
+
+import collections
+import math
+import threading
+import time
+
+
+class ConcurrencyLimiter (object):
+    """ Limits the requests running at once per class. """
+
+    def __init__ (self, limits):
+        """ limits is: class -> max. requests running at once.  0 means no limit. """
+        self.limits   = dict (limits)
+        self.lock     = threading.Lock ()
+        self.running  = collections.Counter ()
+        self.rejected = collections.Counter ()
+
+
+    def acquire (self, cls):
+        """ Return True if a request of cls may run now.  Never waits. """
+        limit = self.limits.get (cls, 0)
+        with self.lock:
+            if limit > 0 and self.running[cls] >= limit:
+                self.rejected[cls] += 1
+                return False
+            self.running[cls] += 1
+            return True
+
+
+    def release (self, cls):
+        """ A request of cls has finished.  cls None is ignored. """
+        if cls is None:
+            return
+        with self.lock:
+            self.running[cls] -= 1
+
+
+class TokenBuckets (object):
+    """ Rate limits per class and client. """
+
+    def __init__ (self, rates, max_clients = 10000):
+        """ rates is: class -> (requests per second, burst). """
+        self.rates       = { cls : rate for cls, rate in rates.items () if rate[0] > 0 }
+        self.max_clients = max_clients
+        self.lock        = threading.Lock ()
+        self.buckets     = collections.OrderedDict ()
+        self.rejected    = collections.Counter ()
+
+
+    def take (self, cls, client):
+        """Take a token from the bucket of client.
+
+        Returns 0 if the request may run, else the seconds until the next token.
+
+        """
+        if cls not in self.rates:
+            return 0
+        rate, burst = self.rates[cls]
+        key = (cls, client)
+        now = time.monotonic ()
+
+        with self.lock:
+            tokens, last = self.buckets.pop (key, (burst, now))
+            tokens = min (burst, tokens + (now - last) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+                self.rejected[cls] += 1
+            self.buckets[key] = (tokens, now)
+            # forget the clients not seen for the longest time
+            while len (self.buckets) > self.max_clients:
+                self.buckets.popitem (last = False)
+            return wait
+
+
+def retry_after (seconds):
+    """ Format seconds for the Retry-After header. """
+    return max (1, math.ceil (seconds))
@@ -0,0 +1,400 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+"""An ASGI entry point for the API
+
+Usage: asgi.py -c CONFIG_FILE [-c CONFIG_FILE ...] [-v]
+
+Or from an ASGI server: create_application (server.create_app ([CONFIG_FILE]))
+
+The endpoints that must query MySQL have async variants here.  They use an
+async driver (aiomysql) through a bounded connection pool, so that one slow
+full-text query does not stall the other requests.  All other requests, eg.
+those answered from the in-memory indexes, run the WSGI app in a bounded thread
+pool.
+
+Requires: uvicorn, aiomysql (or aiosqlite)
+
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import io
+import logging
+import os.path
+import sys
+import time
+
+import flask
+from flask import current_app, request
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.sql import text
+from werkzeug.exceptions import HTTPException
+
+import server
+from server import logger
+
+
+app = None
+""" The flask app, see: create_application """
+
+executor = None
+""" Runs the WSGI app and the startup. """
+
+flights = {}
+""" The futures of the async endpoint calls in progress by cache key. """
+
+
+class AsyncMySQLEngine (server.MySQLEngine):
+    """ Async Database Interface """
+
+    def __init__ (self, **kwargs):
+
+        args = self.get_connection_params (kwargs)
+
+        self.url = 'mysql+aiomysql://{user}:{password}@{host}:{port}/{database}'.format (**args)
+        logger.log (logging.INFO,
+                    'AsyncMySQLEngine: Connecting to mysql+aiomysql://{user}:password@{host}:{port}/{database}'.format (**args))
+        self.engine = create_async_engine (self.url + '?charset=utf8mb4&sql_mode=ANSI',
+                                           pool_size = kwargs.get ('ASYNC_POOL_SIZE', 10),
+                                           max_overflow = 0,
+                                           pool_timeout = kwargs.get ('ASYNC_POOL_TIMEOUT', 10),
+                                           pool_recycle = kwargs.get ('MYSQL_POOL_RECYCLE', 300),
+                                           pool_pre_ping = kwargs.get ('MYSQL_POOL_PRE_PING', True))
+
+
+class AsyncSQLiteEngine (server.SQLiteEngine):
+    """ Async embedded read-only Database Interface """
+
+    def __init__ (self, **kwargs):
+
+        path = os.path.expanduser (kwargs['SQLITE_FILE'])
+
+        self.url = 'sqlite+aiosqlite:///' + path
+        logger.log (logging.INFO, 'AsyncSQLiteEngine: Opening %s', path)
+        self.engine = create_async_engine ('sqlite+aiosqlite:///file:%s?mode=ro&uri=true' % path)
+
+
+ASYNC_ENGINES = {
+    'mysql'  : AsyncMySQLEngine,
+    'sqlite' : AsyncSQLiteEngine,
+}
+
+
+async def execute (statement, sql, parameters, debug_level = logging.DEBUG):
+    """ Execute a query on the async engine and return all rows. """
+    start_time = time.monotonic ()
+    async with current_app.config.async_dba.engine.connect () as conn:
+        result = await conn.execute (text (sql.strip ()), parameters)
+        rows = result.fetchall ()
+    seconds = time.monotonic () - start_time
+    logger.log (debug_level, '%d rows in %.3fs', len (rows), seconds)
+    server.record_statement (statement, seconds, len (rows))
+    server.log_slow_query (statement, sql, parameters, seconds)
+    return rows
+
+
+#
+# async variants of the endpoints
+#
+# They return None if the request does not need the database.  Those requests
+# are passed on to the WSGI app.
+#
+
+async def headwords ():
+    """ Endpoint.  Retrieve a list of headword IDs. """
+
+    # the in-memory searches take up to a second: run them in the thread pool,
+    # not on the event loop
+    config = current_app.config
+    if 'ids' in request.args or server.fuzzy_arg ():
+        return None
+    if request.args.get ('fulltext'):
+        if config.fulltext_index is not None:
+            return None
+    elif config.hwi is not None:
+        return None
+
+    q, fulltext, offset, limit, cursor = server.headwords_args ()
+    statement, sql, params = server.headwords_sql (q, fulltext, offset, limit, cursor)
+    rows = await execute (statement, sql, params)
+    return server.make_headwords_response (rows, limit, paged = True)
+
+
+async def headwords_id_context (_id):
+    """ Retrieve a list of headwords around a given headword. """
+
+    if current_app.config.hwi is not None:
+        return None
+
+    limit = server.clip (server.arg ('limit', str (server.MAX_RESULTS), server.re_integer_arg),
+                         1, server.MAX_RESULTS)
+    rows = await execute ('headword context', server.CONTEXT_SQL, { 'id' : _id, 'limit' : limit, 'limit1' : limit + 1 })
+    if not rows:
+        flask.abort (404)
+    return server.make_headwords_response (rows, limit)
+
+
+async def articles_id_formats (_id):
+    """ Endpoint.  Retrieve an article's available formats. """
+
+    if current_app.config.formats_store is not None:
+        return None
+
+    rows = await execute ('article webtext', server.WEBTEXT_SQL, { 'no' : _id })
+    if not rows:
+        flask.abort (404)
+    return server.make_json_response (server.make_formats (_id, rows[0][0]))
+
+
+ASYNC_ENDPOINTS = {
+    'headwords'            : headwords,
+    'headwords_id_context' : headwords_id_context,
+    'articles_id_formats'  : articles_id_formats,
+}
+
+
+async def cached (f, view_args):
+    """ Like server.cached but for async endpoints. """
+
+    cache = current_app.config.response_cache
+    timeout = current_app.config.get ('SINGLE_FLIGHT_TIMEOUT', 5)
+    if cache.size <= 0 and timeout <= 0:
+        return await f (**view_args)
+
+    key = server.cache_key (view_args)
+    hit = cache.get (key) if cache.size > 0 else None
+    if hit is None and key in flights:
+        try:
+            hit = await asyncio.wait_for (asyncio.shield (flights[key]), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if hit is not None:
+            flight = current_app.config.single_flight
+            with flight.lock:
+                flight.shared += 1
+
+    if hit is None:
+        future = asyncio.get_running_loop ().create_future ()
+        flights.setdefault (key, future)
+        try:
+            resp = await f (**view_args)
+            if resp is None or resp.status_code != 200:
+                return resp
+            hit = server.cache_entry (resp)
+            cache.put (key, hit)
+        finally:
+            # waiters get None on errors and call the endpoint themselves
+            future.set_result (hit)
+            if flights.get (key) is future:
+                del flights[key]
+
+    return server.response_from_cache (hit)
+
+
+#
+# ASGI glue
+#
+
+def make_environ (scope, body):
+    """ Build a WSGI environ from an ASGI http scope. """
+
+    root_path = scope.get ('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith (root_path):
+        path = path[len (root_path):]
+
+    environ = {
+        'REQUEST_METHOD'    : scope['method'],
+        'SCRIPT_NAME'       : root_path.encode ('utf-8').decode ('latin-1'),
+        'PATH_INFO'         : path.encode ('utf-8').decode ('latin-1'),
+        'QUERY_STRING'      : scope['query_string'].decode ('latin-1'),
+        'SERVER_PROTOCOL'   : 'HTTP/%s' % scope['http_version'],
+        'wsgi.version'      : (1, 0),
+        'wsgi.url_scheme'   : scope.get ('scheme', 'http'),
+        'wsgi.input'        : io.BytesIO (body),
+        'wsgi.errors'       : sys.stderr,
+        'wsgi.multithread'  : True,
+        'wsgi.multiprocess' : False,
+        'wsgi.run_once'     : False,
+    }
+
+    host, port = scope.get ('server') or ('localhost', 80)
+    environ['SERVER_NAME'] = host
+    environ['SERVER_PORT'] = str (port)
+    if scope.get ('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope['headers']:
+        name = name.decode ('latin-1').upper ().replace ('-', '_')
+        value = value.decode ('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+
+    return environ
+
+
+def call_wsgi (environ):
+    """ Call the WSGI app.  Returns: status, headers, body iterable. """
+
+    response = {}
+
+    def start_response (status, headers, exc_info = None):
+        response['status'] = int (status.split (' ', 1)[0])
+        response['headers'] = headers
+
+    chunks = app (environ, start_response)
+    return response['status'], response['headers'], chunks
+
+
+async def send_chunks (send, chunks, context):
+    """Send a WSGI body iterable chunk by chunk.
+
+    The chunks are pulled in the thread pool, because a streamed body, eg. the
+    export, queries the database while it is iterated.  All pulls run in the
+    same context, so that flask.stream_with_context finds its request context.
+
+    """
+    loop = asyncio.get_running_loop ()
+    iterator = iter (chunks)
+    try:
+        while True:
+            chunk = await loop.run_in_executor (executor, context.run, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send ({
+                    'type'      : 'http.response.body',
+                    'body'      : chunk,
+                    'more_body' : True,
+                })
+        await send ({
+            'type' : 'http.response.body',
+            'body' : b'',
+        })
+    finally:
+        if hasattr (chunks, 'close'):
+            await loop.run_in_executor (executor, context.run, chunks.close)
+
+
+async def call_async (environ):
+    """Call the async variant of the endpoint.
+
+    Returns: status, headers, body or None if there is no async variant or the
+    request does not need the database.
+
+    """
+    try:
+        endpoint, view_args = app.url_map.bind_to_environ (environ).match ()
+    except HTTPException:
+        return None
+
+    f = ASYNC_ENDPOINTS.get (endpoint)
+    if f is None:
+        return None
+
+    with app.request_context (environ):
+        start_time = time.monotonic ()
+        try:
+            server.admit ()
+            try:
+                resp = await cached (f, view_args)
+            finally:
+                server.release ()
+        except HTTPException as e:
+            resp = e.get_response ()
+        if resp is None:
+            return None
+        resp = server.compress_response (resp)
+        body = resp.get_data ()
+        server.record_request (endpoint, resp.status_code, time.monotonic () - start_time, len (body))
+        return resp.status_code, list (resp.headers.items ()), body
+
+
+async def read_body (receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive ()
+        body += message.get ('body', b'')
+        more_body = message.get ('more_body', False)
+    return body
+
+
+async def startup ():
+    """ Run server.startup () off the event loop. """
+    if not app.config.started:
+        await asyncio.get_running_loop ().run_in_executor (executor, server.startup, app)
+
+
+async def lifespan (receive, send):
+    while True:
+        message = await receive ()
+        if message['type'] == 'lifespan.startup':
+            await startup ()
+            await send ({ 'type' : 'lifespan.startup.complete' })
+        elif message['type'] == 'lifespan.shutdown':
+            await app.config.async_dba.engine.dispose ()
+            await send ({ 'type' : 'lifespan.shutdown.complete' })
+            return
+
+
+async def application (scope, receive, send):
+    """ The ASGI application. """
+
+    if scope['type'] == 'lifespan':
+        await lifespan (receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    await startup ()
+    environ = make_environ (scope, await read_body (receive))
+
+    response = await call_async (environ)
+    if response is None:
+        context = contextvars.copy_context ()
+        response = await asyncio.get_running_loop ().run_in_executor (
+            executor, context.run, call_wsgi, environ)
+    status, headers, body = response
+
+    await send ({
+        'type'    : 'http.response.start',
+        'status'  : status,
+        'headers' : [(k.lower ().encode ('latin-1'), v.encode ('latin-1')) for k, v in headers],
+    })
+    if isinstance (body, bytes):
+        await send ({
+            'type' : 'http.response.body',
+            'body' : body,
+        })
+    else:
+        await send_chunks (send, body, context)
+
+
+def create_application (flask_app):
+    """ Return the ASGI application serving flask_app. """
+
+    global app, executor
+    app = flask_app
+    app.config.async_dba = ASYNC_ENGINES[app.config.get ('DATABASE', 'mysql')] (**app.config)
+    executor = concurrent.futures.ThreadPoolExecutor (max_workers = app.config.get ('ASGI_THREADS', 8))
+    return application
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = server.build_parser ().parse_args ()
+    server.configure_logging (args)
+    flask_app = server.create_app (args.config_file)
+
+    uvicorn.run (create_application (flask_app),
+                 host = 'localhost',
+                 port = flask_app.config.get ('APPLICATION_PORT', 5000),
+                 root_path = flask_app.config.get ('APPLICATION_ROOT', ''),
+                 log_level = logging.getLevelName (args.log_level).lower ())
@@ -0,0 +1,487 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+"""Benchmark the API against a synthetic dictionary
+
+Usage: benchmark.py [--sizes 1000,10000] [--requests 200] [--clients 8]
+                    [--entry server.py] [--workers 1] [--output-dir bench-results]
+       benchmark.py --compare OLD.json NEW.json [--threshold 1.2]
+
+Generates a CPD-shaped SQLite database for each size (in articles), drives
+every route in app.url_map through the Flask test client and through an HTTP
+server with a multi-client load generator, and reports throughput and p50/p99
+latency per endpoint.  The results are stored as JSON in the output directory.
+Compare two result files to find regressions between versions.
+
+Also checks that the headword index answers the headwords queries exactly like
+SQL, and exits with status 1 if not.
+
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import os.path
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unicodedata
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+
+SYLLABLES = (
+    'a ā i ī u ū e o ka kha ga gha ca cha ja ṭa ḍa ṇa ta tha da dha na pa pha ba bha '
+    'ma ya ra la va sa ha ḷa ṁ ñā ku ti pu sī vi mo ru dhā kā ni'
+).split ()
+
+WEB_PREFIXES = ('', '', '', '', '°', '[', '√', '-')
+
+# Same schema as server.export_sqlite
+SCHEMA = """
+CREATE TABLE keyword (
+  id          INTEGER PRIMARY KEY,
+  keyword     TEXT    NOT NULL COLLATE NOCASE,
+  webkeyword  TEXT    NOT NULL,
+  sortkeyword TEXT    NOT NULL,
+  n           INTEGER NOT NULL,
+  no          INTEGER NOT NULL
+);
+CREATE TABLE article (
+  no          INTEGER PRIMARY KEY,
+  webtext     TEXT,
+  idxtext     TEXT
+);
+"""
+
+INDEXES = """
+CREATE INDEX keyword_sortkeyword ON keyword (sortkeyword, n, no, id);
+CREATE INDEX keyword_no ON keyword (no);
+CREATE INDEX keyword_keyword ON keyword (keyword);
+ANALYZE;
+"""
+
+SAMPLE_QUERIES = {
+    'headwords' : [
+        'limit=100',
+        'q={prefix}*&limit=100',
+        'q=*{infix}*&limit=100',
+        'q={prefix}*&fulltext={word}&limit=100',
+        'q={word}&fuzzy=1&limit=100',
+        'ids={headword_ids}',
+    ],
+    'headwords_suggest'    : [ 'prefix={prefix}', 'prefix={prefix}&limit=100' ],
+    'headwords_id_context' : [ 'limit=10' ],
+    'articles'             : [ 'limit=100' ],
+    'articles_formats'     : [ 'ids={article_nos}' ],
+    'articles_id_headwords': [ 'limit=100' ],
+    'export'               : [ '', 'formats=1' ],
+}
+""" Query strings per endpoint.  Endpoints not listed are called without. """
+
+INDEX_CHECK_URLS = [
+    '/v1/headwords?limit=100',
+    '/v1/headwords?q={prefix}*&limit=100',
+    '/v1/headwords?q=*{infix}*&limit=100',
+    '/v1/headwords?q={prefix}?*&limit=100',
+    '/v1/headwords?q=?{infix}*&limit=100',
+    '/v1/headwords?q={word}&limit=100',
+    '/v1/headwords?q={prefix}*&offset=5&limit=10',
+    '/v1/headwords?q={prefix}*&fulltext={word}&limit=100',
+    '/v1/headwords?ids={headword_ids}',
+    '/v1/headwords/suggest?prefix={prefix}&limit=100',
+]
+""" The urls the headword index must answer exactly like SQL. """
+
+
+def fold (s):
+    """ Like headword_index.fold """
+    return ''.join (c for c in unicodedata.normalize ('NFD', s)
+                    if not unicodedata.combining (c)).casefold ()
+
+
+def make_word (rnd):
+    return ''.join (rnd.choice (SYLLABLES) for _ in range (rnd.randint (2, 5)))
+
+
+def make_dataset (path, size, seed = 1):
+    """Generate a synthetic dictionary with size articles.
+
+    Returns the sample parameters for the queries.
+
+    """
+    rnd = random.Random (seed)
+    vocabulary = [make_word (rnd) for _ in range (max (1000, size // 2))]
+
+    if os.path.exists (path):
+        os.remove (path)
+    db = sqlite3.connect (path)
+    db.executescript (SCHEMA)
+
+    keywords = []
+    articles = []
+    _id = 0
+    for no in range (1, size + 1):
+        for n in range (rnd.choice ((1, 1, 1, 2, 3))):
+            _id += 1
+            word = make_word (rnd)
+            web = rnd.choice (WEB_PREFIXES) + word
+            if n:
+                web = '<sup>%d</sup>%s' % (n, web)
+            keywords.append ((_id, fold (word), web, word, n, no))
+        # zipf-like word frequencies
+        words = [vocabulary[min (int (rnd.paretovariate (1.2)) - 1, len (vocabulary) - 1)]
+                 for _ in range (rnd.randint (20, 200))]
+        idxtext = ' '.join (words)
+        articles.append ((no, '<div class="article"><b>%s</b> %s</div>' % (keywords[-1][2], idxtext),
+                          idxtext))
+
+    db.executemany ('INSERT INTO keyword VALUES (?, ?, ?, ?, ?, ?)', keywords)
+    db.executemany ('INSERT INTO article VALUES (?, ?, ?)', articles)
+    db.executescript (INDEXES)
+    db.commit ()
+    db.close ()
+
+    middle = keywords[len (keywords) // 2]
+    return {
+        'headword_id'  : middle[0],
+        'article_no'   : middle[5],
+        'prefix'       : middle[1][:2],
+        'infix'        : middle[1][1:3],
+        'word'         : vocabulary[0],
+        'headword_ids' : ','.join (str (k[0]) for k in rnd.sample (keywords, min (50, len (keywords)))),
+        'article_nos'  : ','.join (str (a[0]) for a in rnd.sample (articles, min (50, len (articles)))),
+    }
+
+
+def write_config (path, db_path, port, cache):
+    with open (path, 'w') as fp:
+        fp.write ('DATABASE="sqlite"\n')
+        fp.write ('SQLITE_FILE=%r\n' % db_path)
+        fp.write ('FULLTEXT_BACKEND="index"\n')
+        fp.write ('RESPONSE_CACHE_SIZE=%d\n' % (1000 if cache else 0))
+        fp.write ('APPLICATION_PORT=%d\n' % port)
+        fp.write ('APPLICATION_ROOT=""\n')
+        # measure the queries, not the admission control
+        fp.write ('CONCURRENCY_LIMITS={}\n')
+        fp.write ('RATE_LIMITS={}\n')
+
+
+def free_port ():
+    with socket.socket () as s:
+        s.bind (('localhost', 0))
+        return s.getsockname ()[1]
+
+
+def percentile (sorted_values, p):
+    """ Nearest-rank percentile of a sorted list. """
+    if not sorted_values:
+        return None
+    k = max (0, min (len (sorted_values) - 1, int (round (p / 100 * len (sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize (latencies, errors, seconds):
+    latencies = sorted (latencies)
+    return {
+        'requests' : len (latencies),
+        'errors'   : errors,
+        'rps'      : len (latencies) / seconds if seconds else None,
+        'p50'      : percentile (latencies, 50),
+        'p99'      : percentile (latencies, 99),
+    }
+
+
+#
+# the worker runs in a subprocess, so that every dataset gets a fresh process
+#
+
+def sample_urls (app, params):
+    """ Build the sample urls for every route in app.url_map. """
+
+    params = { k : urllib.parse.quote (str (v), safe = ',') for k, v in params.items () }
+    urls = []
+    adapter = app.url_map.bind ('localhost')
+    for rule in app.url_map.iter_rules ():
+        if rule.endpoint == 'gateway_headwords' and not app.config.get ('GATEWAY_BACKENDS'):
+            continue
+        values = {}
+        if '_id' in rule.arguments:
+            key = 'article_no' if rule.endpoint.startswith ('articles') else 'headword_id'
+            values['_id'] = params[key]
+        path = adapter.build (rule.endpoint, values)
+        for query in SAMPLE_QUERIES.get (rule.endpoint, ['']):
+            query = query.format (**params)
+            urls.append ((rule.endpoint, path + ('?' + query if query else '')))
+    return urls
+
+
+def check_index (app, sql_app, params):
+    """Compare the answers of the headword index with those of SQL.
+
+    Follows the cursor of the first page to the second.  Returns the urls
+    whose answers differ.
+
+    """
+    params = { k : urllib.parse.quote (str (v), safe = ',') for k, v in params.items () }
+    index_client = app.test_client ()
+    sql_client = sql_app.test_client ()
+    mismatches = []
+    for url in INDEX_CHECK_URLS:
+        url = url.format (**params)
+        for page in range (2):
+            index_json = index_client.get (url).get_json ()
+            if index_json != sql_client.get (url).get_json ():
+                mismatches.append (url)
+                break
+            if 'next' not in index_json:
+                break
+            url = url + '&cursor=' + index_json['next']
+    return mismatches
+
+
+def worker (args):
+    """ Drive every route through the Flask test client. """
+
+    sys.path.insert (0, HERE)
+    import server
+
+    params = json.loads (args.worker)
+    app = server.create_app (args.config_file)
+    with tempfile.NamedTemporaryFile ('w', suffix = '.conf') as fp:
+        fp.write ('HEADWORD_INDEX=False\n')
+        fp.flush ()
+        sql_app = server.create_app (args.config_file + [fp.name])
+    mismatches = check_index (app, sql_app, params)
+
+    client = app.test_client ()
+    results = []
+    urls = sample_urls (app, params)
+    for endpoint, url in urls:
+        client.get (url)  # warm up
+        latencies = []
+        errors = 0
+        start_time = time.monotonic ()
+        for _ in range (args.requests):
+            t = time.monotonic ()
+            resp = client.get (url)
+            resp.get_data ()
+            latencies.append (time.monotonic () - t)
+            if resp.status_code != 200:
+                errors += 1
+        result = summarize (latencies, errors, time.monotonic () - start_time)
+        result.update (endpoint = endpoint, url = url)
+        results.append (result)
+
+    json.dump ({ 'urls' : urls, 'results' : results, 'index_mismatches' : mismatches }, sys.stdout)
+
+
+#
+# the load generator
+#
+
+def fetch (url):
+    """ GET url.  Returns latency, ok. """
+    t = time.monotonic ()
+    try:
+        with urllib.request.urlopen (url, timeout = 60) as resp:
+            resp.read ()
+            ok = resp.status == 200
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return time.monotonic () - t, ok
+
+
+def wait_for (url, timeout = 300):
+    deadline = time.monotonic () + timeout
+    while time.monotonic () < deadline:
+        try:
+            with urllib.request.urlopen (url, timeout = 5):
+                return
+        except (urllib.error.URLError, OSError):
+            time.sleep (0.2)
+    raise RuntimeError ('Server did not start: %s' % url)
+
+
+def load (base_url, urls, requests, clients):
+    """ Drive every url with clients concurrent clients. """
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor (max_workers = clients) as executor:
+        for endpoint, url in urls:
+            fetch (base_url + url)  # warm up
+            start_time = time.monotonic ()
+            responses = list (executor.map (fetch, [base_url + url] * requests))
+            seconds = time.monotonic () - start_time
+            result = summarize ([l for l, ok in responses],
+                                sum (1 for l, ok in responses if not ok), seconds)
+            result.update (endpoint = endpoint, url = url)
+            results.append (result)
+    return results
+
+
+def run_size (args, size, data_dir):
+    """ Benchmark one dataset size.  Returns the results. """
+
+    db_path = os.path.join (data_dir, 'cpd-%d.sqlite' % size)
+    conf_path = os.path.join (data_dir, 'bench-%d.conf' % size)
+    port = free_port ()
+
+    print ('Generating %d articles ...' % size, file = sys.stderr)
+    params = make_dataset (db_path, size)
+    write_config (conf_path, db_path, port, args.cache)
+    configs = sum ((['-c', c] for c in args.config_file + [conf_path]), [])
+
+    print ('Test client ...', file = sys.stderr)
+    out = subprocess.run (
+        [sys.executable, os.path.abspath (__file__), '--worker', json.dumps (params),
+         '--requests', str (args.requests)] + configs,
+        cwd = HERE, check = True, stdout = subprocess.PIPE).stdout
+    out = json.loads (out)
+    results = [dict (r, size = size, mode = 'client') for r in out['results']]
+    for url in out['index_mismatches']:
+        print ('Headword index and SQL differ: %s' % url, file = sys.stderr)
+
+    print ('HTTP with %d clients ...' % args.clients, file = sys.stderr)
+    workers = ['--workers', str (args.workers)] if args.workers > 1 else []
+    proc = subprocess.Popen ([sys.executable, args.entry] + configs + workers, cwd = HERE)
+    try:
+        base_url = 'http://localhost:%d' % port
+        wait_for (base_url + '/v1')
+        for r in load (base_url, out['urls'], args.requests, args.clients):
+            results.append (dict (r, size = size, mode = 'http'))
+    finally:
+        proc.terminate ()
+        proc.wait ()
+
+    return results, out['index_mismatches']
+
+
+def version ():
+    try:
+        return subprocess.run (['git', 'describe', '--always', '--dirty'], cwd = HERE,
+                               stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+                               universal_newlines = True).stdout.strip () or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def print_results (results):
+    fmt = '%-5s %8s  %-60s %9s %9s %9s %6s'
+    print (fmt % ('mode', 'size', 'url', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for r in results:
+        print (fmt % (r['mode'], r['size'], r['url'][:60], '%.1f' % r['rps'],
+                      '%.2f' % (r['p50'] * 1000), '%.2f' % (r['p99'] * 1000), r['errors']))
+
+
+def compare (old_path, new_path, threshold):
+    """ Print the changes between two result files.  Returns the number of regressions. """
+
+    with open (old_path) as fp:
+        old = json.load (fp)
+    with open (new_path) as fp:
+        new = json.load (fp)
+
+    key = lambda r: (r['mode'], r['size'], r['url'])
+    old_results = { key (r) : r for r in old['results'] }
+
+    print ('%s -> %s' % (old['version'], new['version']))
+    fmt = '%-5s %8s  %-60s %9s %9s %s'
+    print (fmt % ('mode', 'size', 'url', 'p50', 'p99', ''))
+    regressions = 0
+    for r in new['results']:
+        o = old_results.get (key (r))
+        if o is None:
+            continue
+        p50 = r['p50'] / o['p50'] if o['p50'] else 1.0
+        p99 = r['p99'] / o['p99'] if o['p99'] else 1.0
+        regressed = p50 > threshold or p99 > threshold
+        regressions += regressed
+        print (fmt % (r['mode'], r['size'], r['url'][:60], '%.2fx' % p50, '%.2fx' % p99,
+                      'REGRESSION' if regressed else ''))
+    return regressions
+
+
+def build_parser ():
+    parser = argparse.ArgumentParser (description = 'Benchmark the API against a synthetic dictionary')
+
+    parser.add_argument ('-c', '--config-file', dest='config_file', action='append', default=[],
+                         help="configuration files (default: instance/cpd.conf)")
+    parser.add_argument ('--sizes', default='1000,10000',
+                         help="comma-separated dataset sizes in articles (default: 1000,10000)")
+    parser.add_argument ('--requests', type=int, default=200,
+                         help="requests per url (default: 200)")
+    parser.add_argument ('--clients', type=int, default=8,
+                         help="concurrent HTTP clients (default: 8)")
+    parser.add_argument ('--entry', default='server.py',
+                         help="the server to start: server.py or asgi.py (default: server.py)")
+    parser.add_argument ('--workers', type=int, default=1,
+                         help="worker processes of server.py (default: 1)")
+    parser.add_argument ('--cache', action='store_true',
+                         help="turn the response cache on")
+    parser.add_argument ('--data-dir',
+                         help="keep the generated datasets here (default: a temporary directory)")
+    parser.add_argument ('--output-dir', default='bench-results',
+                         help="store the results here (default: bench-results)")
+    parser.add_argument ('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                         help="compare two result files")
+    parser.add_argument ('--threshold', type=float, default=1.2,
+                         help="latency ratio that counts as regression (default: 1.2)")
+    parser.add_argument ('--worker', help=argparse.SUPPRESS)
+    return parser
+
+
+def main ():
+    args = build_parser ().parse_args ()
+
+    if args.compare:
+        return 1 if compare (args.compare[0], args.compare[1], args.threshold) else 0
+
+    if args.worker:
+        worker (args)
+        return 0
+
+    args.config_file = [os.path.abspath (c) for c in
+                        args.config_file or [os.path.join (HERE, 'instance', 'cpd.conf')]]
+    sizes = [int (s) for s in args.sizes.split (',')]
+
+    with tempfile.TemporaryDirectory () as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        os.makedirs (data_dir, exist_ok = True)
+        results = []
+        mismatches = []
+        for size in sizes:
+            size_results, size_mismatches = run_size (args, size, data_dir)
+            results.extend (size_results)
+            mismatches.extend (size_mismatches)
+
+    print_results (results)
+
+    now = datetime.datetime.now ()
+    report = {
+        'version' : version (),
+        'date'    : now.isoformat (),
+        'python'  : sys.version,
+        'args'    : { k : v for k, v in vars (args).items () if k not in ('worker', 'compare') },
+        'results' : results,
+        'index_mismatches' : mismatches,
+    }
+    os.makedirs (args.output_dir, exist_ok = True)
+    path = os.path.join (args.output_dir, '%s-%s.json' % (now.strftime ('%Y%m%d-%H%M%S'), report['version']))
+    with open (path, 'w') as fp:
+        json.dump (report, fp, indent = 2)
+    print ('Results stored in %s' % path, file = sys.stderr)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit (main ())
@@ -0,0 +1,97 @@
+# -*- encoding: utf-8 -*-
+
+"""Content encodings for HTTP responses
+
+gzip is always available.  brotli (br) and zstd are offered if the brotli or
+zstandard packages are installed.
+
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCompressor (object):
+    """ A streaming gzip compressor. """
+
+    def __init__ (self, level = 6):
+        self.z = zlib.compressobj (level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress (self, data):
+        return self.z.compress (data)
+
+    def flush (self):
+        return self.z.flush ()
+
+
+class BrotliCompressor (object):
+    """ A streaming brotli compressor. """
+
+    def __init__ (self, level = 5):
+        self.z = brotli.Compressor (quality = level)
+
+    def compress (self, data):
+        return self.z.process (data)
+
+    def flush (self):
+        return self.z.finish ()
+
+
+class ZstdCompressor (object):
+    """ A streaming zstd compressor. """
+
+    def __init__ (self, level = 3):
+        self.z = zstandard.ZstdCompressor (level = level).compressobj ()
+
+    def compress (self, data):
+        return self.z.compress (data)
+
+    def flush (self):
+        return self.z.flush ()
+
+
+COMPRESSORS = {}
+""" The compressor classes by content encoding, the preferred encoding first. """
+
+if zstandard is not None:
+    COMPRESSORS['zstd'] = ZstdCompressor
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+COMPRESSORS['gzip'] = GzipCompressor
+
+ENCODINGS = list (COMPRESSORS)
+
+
+def negotiate (accept_encodings):
+    """Choose the content encoding for the client.
+
+    accept_encodings is the parsed Accept-Encoding header, eg.
+    request.accept_encodings.  Returns None if the client accepts none of ours.
+
+    """
+    return accept_encodings.best_match (ENCODINGS)
+
+
+def compress (encoding, data):
+    """ Compress data in one go. """
+    z = COMPRESSORS[encoding] ()
+    return z.compress (data) + z.flush ()
+
+
+def compress_chunks (encoding, chunks):
+    """ Compress a stream of chunks into one stream. """
+    z = COMPRESSORS[encoding] ()
+    for chunk in chunks:
+        out = z.compress (chunk)
+        if out:
+            yield out
+    yield z.flush ()
@@ -0,0 +1,79 @@
+# -*- encoding: utf-8 -*-
+
+"""A precomputed store of the article formats
+
+The store is an SQLite file that maps the article no to the serialized
+response of the formats endpoint.  It is built offline and opened read-only by
+the server, which then serves the stored bytes as they are.
+
+"""
+
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+logger = logging.getLogger ('server')
+
+
+class FormatsStore (object):
+    """ Read-only access to the formats store. """
+
+    def __init__ (self, path):
+        self.path = os.path.expanduser (path)
+        self.local = threading.local ()
+        # fail early if the store is missing
+        self.connection ()
+        logger.log (logging.INFO, 'FormatsStore: Opened %s', self.path)
+
+
+    def connection (self):
+        """ Return the connection of this thread. """
+        conn = getattr (self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect ('file:%s?mode=ro' % self.path, uri = True)
+            self.local.conn = conn
+        return conn
+
+
+    def reset (self):
+        """ Forget the connections, eg. in a forked process. """
+        self.local = threading.local ()
+
+
+    def get (self, no):
+        """ Return the stored bytes for article no or None. """
+        row = self.connection ().execute (
+            'SELECT body FROM formats WHERE no = ?', (no, )).fetchone ()
+        return None if row is None else row[0]
+
+
+    @staticmethod
+    def build (path, items):
+        """Build a new store.
+
+        items is an iterable of: article_no, serialized body.  The new store
+        replaces the old one atomically.
+
+        """
+        path = os.path.expanduser (path)
+        # a unique name: workers starting together may all build the store
+        fd, tmp_path = tempfile.mkstemp (dir = os.path.dirname (path),
+                                         prefix = os.path.basename (path) + '.', suffix = '.tmp')
+        os.close (fd)
+        os.chmod (tmp_path, 0o644)
+
+        conn = sqlite3.connect (tmp_path)
+        conn.execute ('CREATE TABLE formats (no INTEGER PRIMARY KEY, body BLOB NOT NULL)')
+        count = 0
+        for no, body in items:
+            conn.execute ('INSERT INTO formats (no, body) VALUES (?, ?)', (no, body))
+            count += 1
+        conn.commit ()
+        conn.close ()
+
+        os.replace (tmp_path, path)
+        logger.log (logging.INFO, 'FormatsStore: Stored %d articles in %s', count, path)
+        return count
@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+
+"""Full-text search backends
+
+The 'mysql' backend is the MATCH ... AGAINST query in server.py.  The 'index'
+backend is an in-memory inverted index over article.idxtext with positional
+postings.
+
+The index understands a subset of the MySQL boolean mode syntax:
+
+  word      the article should contain word
+  +word     the article must contain word
+  -word     the article must not contain word
+  word*     any word beginning with word
+  "a b"     the phrase 'a b'
+
+Tokens are folded like the headword search keys: diacritics and case are not
+significant.  Combining marks do not split words.
+
+"""
+
+import array
+import bisect
+import collections
+import logging
+import math
+import re
+
+from sqlalchemy.sql import text
+
+from headword_index import fold
+
+
+logger = logging.getLogger ('server')
+
+re_token  = re.compile (r'(?:\w|[\u0300-\u036f])+')
+re_clause = re.compile (r'([+-]?)(?:"([^"]*)"|(\S+))')
+
+
+def tokenize (s):
+    """ Return the list of folded tokens in s. """
+    return [fold (t) for t in re_token.findall (s)]
+
+
+class FulltextIndex (object):
+    """ An inverted index with positional postings. """
+
+    def __init__ (self, rows):
+        """ rows is: article_no, idxtext """
+
+        postings = collections.defaultdict (dict)
+        n_docs = 0
+        for no, idxtext in rows:
+            n_docs += 1
+            for pos, token in enumerate (tokenize (idxtext or '')):
+                postings[token].setdefault (no, array.array ('L')).append (pos)
+
+        self.n_docs   = n_docs
+        self.postings = dict (postings)
+        self.terms    = sorted (self.postings)
+
+        logger.log (logging.INFO, 'FulltextIndex: %d articles, %d terms',
+                    self.n_docs, len (self.terms))
+
+
+    @classmethod
+    def from_db (cls, conn):
+        """ Build the index from the database. """
+        res = conn.execution_options (stream_results = True).execute (text (
+            'SELECT no, idxtext FROM article'))
+        return cls (res)
+
+
+    def _expand (self, term):
+        """ Return the terms in the index matching term, which may end in '*'. """
+        if not term.endswith ('*'):
+            return [term] if term in self.postings else []
+        prefix = term.rstrip ('*')
+        i = bisect.bisect_left (self.terms, prefix)
+        result = []
+        while i < len (self.terms) and self.terms[i].startswith (prefix):
+            result.append (self.terms[i])
+            i += 1
+        return result
+
+
+    def _score (self, postings):
+        """ Add the tf-idf scores of postings to a dict no -> score. """
+        idf = math.log (1 + self.n_docs / len (postings))
+        return { no : len (positions) * idf for no, positions in postings.items () }
+
+
+    def _word (self, word):
+        """ Return no -> score for the articles containing word. """
+        scores = collections.Counter ()
+        for term in self._expand (word):
+            scores.update (self._score (self.postings[term]))
+        return scores
+
+
+    def _phrase (self, words):
+        """ Return no -> score for the articles containing the phrase. """
+        if not words or any (w not in self.postings for w in words):
+            return {}
+        first = self.postings[words[0]]
+        scores = {}
+        for no, positions in first.items ():
+            following = [self.postings[w].get (no) for w in words[1:]]
+            if None in following:
+                continue
+            following = [set (p) for p in following]
+            hits = sum (1 for pos in positions
+                        if all ((pos + i + 1) in f for i, f in enumerate (following)))
+            if hits:
+                scores[no] = hits
+        if not scores:
+            return {}
+        idf = math.log (1 + self.n_docs / len (scores))
+        return { no : hits * idf for no, hits in scores.items () }
+
+
+    def search (self, query):
+        """ Return the article nos matching query, best match first. """
+
+        required = []
+        optional = []
+        excluded = set ()
+
+        for op, phrase, word in re_clause.findall (query):
+            if phrase:
+                scores = self._phrase (tokenize (phrase))
+            else:
+                tokens = tokenize (word)
+                if not tokens:
+                    continue
+                if word.endswith ('*'):
+                    tokens[-1] += '*'
+                if len (tokens) == 1:
+                    scores = self._word (tokens[0])
+                else:
+                    # eg. a hyphenated word
+                    scores = self._phrase (tokens)
+
+            if op == '+':
+                required.append (scores)
+            elif op == '-':
+                excluded.update (scores)
+            else:
+                optional.append (scores)
+
+        result = collections.Counter ()
+        if required:
+            nos = set (required[0])
+            for scores in required[1:]:
+                nos.intersection_update (scores)
+            for scores in required + optional:
+                result.update ({ no : s for no, s in scores.items () if no in nos })
+        else:
+            for scores in optional:
+                result.update (scores)
+
+        for no in excluded:
+            result.pop (no, None)
+
+        return [no for no, score in sorted (result.items (), key = lambda x: (-x[1], x[0]))]
+
+
+BACKENDS = {
+    'index' : FulltextIndex,
+}
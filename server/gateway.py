@@ -0,0 +1,248 @@
+# -*- encoding: utf-8 -*-
+
+"""A federated search over many M-SALT APIs
+
+The gateway sends one headwords query to all configured dictionaries at once
+and merges the answers, so that a client needs one round trip instead of one
+per dictionary.  Each dictionary gets a timeout: a slow or dead dictionary is
+reported as such but does not hold up the others.  The HTTP connections are
+kept alive and reused.  Successful answers are cached.
+
+The dictionaries are read from a JSON file in the format of the client's
+api-list.json: a list of objects with id, short_name and url.
+
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import http.client
+import json
+import logging
+import os.path
+import time
+import urllib.parse
+
+from response_cache import LRUCache
+import t13n
+
+
+logger = logging.getLogger ('server')
+
+FORWARDED_ARGS = ('q', 'fulltext', 'lang', 'limit', 'offset', 'fuzzy')
+""" The query parameters passed on to the dictionaries. """
+
+
+class BackendError (Exception):
+    """ A dictionary failed to answer. """
+    pass
+
+
+class ConnectionPool (object):
+    """ Keep-alive HTTP connections to one host. """
+
+    def __init__ (self, url, size = 10):
+        parts = urllib.parse.urlsplit (url)
+        self.connection_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.netloc = parts.netloc
+        self.size   = size
+        self.idle   = collections.deque ()
+
+
+    def get (self, path, timeout):
+        """ GET path.  Returns: status, body. """
+
+        for attempt in (0, 1):
+            try:
+                conn = self.idle.pop ()
+                reused = True
+            except IndexError:
+                conn = self.connection_class (self.netloc, timeout = timeout)
+                reused = False
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout (timeout)
+
+            try:
+                conn.request ('GET', path, headers = {
+                    'Accept'          : 'application/json',
+                    'Accept-Encoding' : 'gzip',
+                })
+                resp = conn.getresponse ()
+                body = resp.read ()
+            except TimeoutError:
+                conn.close ()
+                raise
+            except (http.client.HTTPException, OSError):
+                conn.close ()
+                if reused and attempt == 0:
+                    # the server closed the idle connection, try a fresh one
+                    continue
+                raise
+
+            if resp.will_close or len (self.idle) >= self.size:
+                conn.close ()
+            else:
+                self.idle.append (conn)
+
+            if resp.getheader ('Content-Encoding') == 'gzip':
+                body = gzip.decompress (body)
+            return resp.status, body
+
+
+    def reset (self):
+        """ Drop all idle connections. """
+        while self.idle:
+            self.idle.pop ().close ()
+
+
+class Backend (object):
+    """ One dictionary. """
+
+    def __init__ (self, id, short_name, url, timeout, pool_size):
+        self.id         = id
+        self.short_name = short_name
+        self.url        = url if url.endswith ('/') else url + '/'
+        self.timeout    = timeout
+        self.path       = urllib.parse.urlsplit (self.url).path
+        self.pool       = ConnectionPool (self.url, pool_size)
+        self.langs      = None
+
+
+    def get_json (self, path, deadline):
+        """ GET path relative to the API root and decode the JSON. """
+        timeout = deadline - time.monotonic ()
+        if timeout <= 0:
+            raise TimeoutError ()
+        status, body = self.pool.get (self.path + path, timeout)
+        if status != 200:
+            raise BackendError ('HTTP status %d' % status)
+        return json.loads (body.decode ('utf-8'))
+
+
+    def supported_langs (self, deadline):
+        """Return the transliterations the dictionary accepts in queries.
+
+        Returns a dict: transliteration -> language tag.
+
+        """
+        if self.langs is None:
+            info = self.get_json ('v1', deadline)
+            self.langs = { t13n.parse_lang (lang) : lang for lang in info.get ('supported_langs_query', []) }
+        return self.langs
+
+
+    def query_args (self, args, deadline):
+        """Adapt the query to the dictionary.
+
+        If the dictionary does not understand the transliteration of the query,
+        the query is converted to ISO 15919.
+
+        """
+        args = dict (args)
+        scheme = t13n.parse_lang (args['lang']) if args.get ('lang') else t13n.ISO
+        langs = self.supported_langs (deadline)
+        if scheme in langs:
+            return args
+        if t13n.ISO not in langs or scheme not in t13n.SUPPORTED:
+            raise BackendError ('Unsupported lang parameter')
+        for name in ('q', 'fulltext'):
+            if args.get (name):
+                args[name] = t13n.to_iso (args[name], scheme)
+        args['lang'] = langs[t13n.ISO]
+        return args
+
+
+class Gateway (object):
+    """ Searches all dictionaries in parallel. """
+
+    def __init__ (self, backends, threads = 16, cache_size = 1000, cache_ttl = 300):
+        self.backends = backends
+        self.executor = concurrent.futures.ThreadPoolExecutor (max_workers = threads)
+        self.cache    = LRUCache (cache_size, cache_ttl)
+
+
+    @classmethod
+    def from_config (cls, config):
+        """ Build the gateway from the GATEWAY_* keys of the app config. """
+        path = os.path.expanduser (config['GATEWAY_BACKENDS'])
+        with open (path, 'r', encoding = 'utf-8') as fp:
+            entries = json.load (fp)
+        timeout = config.get ('GATEWAY_TIMEOUT', 5)
+        backends = [
+            Backend (e['id'], e.get ('short_name', e['id']), e['url'], e.get ('timeout', timeout),
+                     config.get ('GATEWAY_POOL_SIZE', 10))
+            for e in entries
+        ]
+        logger.log (logging.INFO, 'Gateway: %d dictionaries from %s', len (backends), path)
+        return cls (backends,
+                    config.get ('GATEWAY_THREADS', 16),
+                    config.get ('GATEWAY_CACHE_SIZE', 1000),
+                    config.get ('GATEWAY_CACHE_TTL', 300))
+
+
+    def query (self, backend, args):
+        """ Send the headwords query to one dictionary.  Returns the decoded answer. """
+
+        key = (backend.id, args)
+        hit = self.cache.get (key)
+        if hit is not None:
+            return hit
+        deadline = time.monotonic () + backend.timeout
+        query = urllib.parse.urlencode (backend.query_args (args, deadline))
+        result = backend.get_json ('v1/headwords?' + query, deadline)
+        self.cache.put (key, result)
+        return result
+
+
+    def search (self, args):
+        """Search all dictionaries.
+
+        args are the query parameters of the headwords endpoint.  Returns the
+        merged response object.
+
+        """
+        args = tuple (sorted ((k, v) for k, v in args if k in FORWARDED_ARGS))
+        futures = [self.executor.submit (self.query, backend, args) for backend in self.backends]
+        concurrent.futures.wait (futures, max ((b.timeout for b in self.backends), default = 0))
+
+        data = []
+        dictionaries = []
+        for backend, future in zip (self.backends, futures):
+            status = {
+                'id'         : backend.id,
+                'short_name' : backend.short_name,
+                'url'        : backend.url,
+            }
+            if not future.done ():
+                future.cancel ()
+                status['status'] = 'timeout'
+            elif isinstance (future.exception (), TimeoutError):
+                status['status'] = 'timeout'
+            elif future.exception () is not None:
+                status['status'] = 'error'
+                status['message'] = str (future.exception ()) or type (future.exception ()).__name__
+                logger.log (logging.WARNING, 'Gateway: %s: %s', backend.id, status['message'])
+            else:
+                result = future.result ()
+                status['status'] = 'ok'
+                status['limit'] = result.get ('limit')
+                if 'next' in result:
+                    status['next'] = result['next']
+                for headword in result.get ('data', []):
+                    headword = dict (headword)
+                    headword['dictionary_id'] = backend.id
+                    data.append (headword)
+            dictionaries.append (status)
+
+        return {
+            'data'         : data,
+            'dictionaries' : dictionaries,
+        }
+
+
+    def reset (self):
+        """ Drop the connections a worker process must not share with the master. """
+        for backend in self.backends:
+            backend.pool.reset ()
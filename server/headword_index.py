@@ -0,0 +1,534 @@
+# -*- encoding: utf-8 -*-
+
+"""An in-memory index of the headwords
+
+The index holds the whole keyword table in wordlist order, that is, in the
+order given by `ORDER BY sortkeyword, n, no, id`.  A headword is identified by its
+position in the wordlist.  Because every list of positions we produce is sorted,
+every result comes out in wordlist order without any further sorting.
+
+Strings are stored packed, one blob per column, to keep the index compact.
+Mappings are stored as sorted keys plus slices of one flat positions array.
+Thus the whole index consists of a few flat buffers, which can be saved to a
+file and memory-mapped by any number of worker processes without copying.
+
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import unicodedata
+
+from sqlalchemy.sql import text
+
+
+logger = logging.getLogger ('server')
+
+SEP = '\n'
+""" Separates the search keys in the packed search key string. """
+
+BOW = '\x02'
+""" Marks the beginning of a search key when building trigrams. """
+
+EOW = '\x03'
+""" Marks the end of a search key when building trigrams. """
+
+
+def fold (s):
+    """Fold a string for searching.
+
+    Strips all diacritics and case, like the accent insensitive collation of
+    the keyword column does.
+
+    """
+    s = unicodedata.normalize ('NFD', s)
+    s = ''.join (c for c in s if not unicodedata.combining (c))
+    return s.casefold ()
+
+
+def trigrams (s):
+    """ Return the set of trigrams in s. """
+    return set (s[i:i+3] for i in range (len (s) - 2))
+
+
+def edit_distance (a, b, max_distance):
+    """Return the Levenshtein distance of a and b.
+
+    Returns max_distance + 1 as soon as the distance is known to be greater
+    than max_distance.
+
+    """
+    if abs (len (a) - len (b)) > max_distance:
+        return max_distance + 1
+    previous = list (range (len (b) + 1))
+    for i, ca in enumerate (a, 1):
+        current = [i]
+        for j, cb in enumerate (b, 1):
+            current.append (min (previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min (current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+MAGIC = b'HWIDX02\n'
+""" The first bytes of a saved index. """
+
+BLOCK = 64
+""" Positions per block of key_order, see: key_order_mins. """
+
+
+class StringTable (object):
+    """ A packed read-only list of strings. """
+
+    def __init__ (self, strings = ()):
+        self.offsets = array.array ('L', [0])
+        blob = bytearray ()
+        for s in strings:
+            blob.extend (s.encode ('utf-8'))
+            self.offsets.append (len (blob))
+        self.blob = bytes (blob)
+
+    def __len__ (self):
+        return len (self.offsets) - 1
+
+    def __getitem__ (self, i):
+        return str (self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def find (self, s):
+        """ Return the index of s or None.  The strings must be sorted. """
+        lo, hi = 0, len (self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len (self) and self[lo] == s:
+            return lo
+        return None
+
+
+def flatten (mapping):
+    """Flatten a mapping key -> array of positions.
+
+    Returns the sorted keys, the offsets into the positions array, and the
+    positions array.
+
+    """
+    keys = sorted (mapping)
+    offsets = array.array ('L', [0])
+    positions = array.array ('L')
+    for k in keys:
+        positions.extend (mapping[k])
+        offsets.append (len (positions))
+    return keys, offsets, positions
+
+
+class HeadwordIndex (object):
+    """ An in-memory index of the keyword table. """
+
+    ARRAYS = ('ids', 'nos', 'ns', 'key_offsets', 'sorted_ids', 'id_positions',
+              'no_keys', 'no_offsets', 'no_positions', 'key_order', 'key_order_mins',
+              'trigram_offsets', 'trigram_positions')
+    """ The buffers saved by save (). """
+
+    STRING_TABLES = ('texts', 'sortkeywords', 'iso_texts', 'normalized_texts', 'trigrams')
+
+    def __init__ (self, rows, normalize = None):
+        """ rows is: id, webkeyword, no, keyword, sortkeyword, n
+
+        The rows must be in wordlist order.  If given, normalize (webkeyword)
+        must return the display text and the normalized text of a headword.
+        Both are then precomputed for every row.
+
+        """
+        rows = list (rows)
+
+        self.ids   = array.array ('L', [row[0] for row in rows])
+        self.nos   = array.array ('L', [row[2] for row in rows])
+        self.ns    = array.array ('L', [row[5] or 0 for row in rows])
+        self.texts = StringTable ([row[1] for row in rows])
+        self.sortkeywords = StringTable ([row[4] or '' for row in rows])
+
+        self.iso_texts = self.normalized_texts = None
+        if normalize is not None:
+            normalized = [normalize (row[1]) for row in rows]
+            self.iso_texts        = StringTable ([n[0] for n in normalized])
+            self.normalized_texts = StringTable ([n[1] for n in normalized])
+
+        # All search keys packed into one string, each followed by SEP.  We can
+        # run a regex over this string to find all matching keys in one pass.
+        keys = [fold (row[3] or '') for row in rows]
+        self.keys = ''.join (k + SEP for k in keys)
+        self.key_offsets = array.array ('L', [0])
+        for k in keys:
+            self.key_offsets.append (self.key_offsets[-1] + len (k) + 1)
+
+        # position lookup by headword id
+        by_id = sorted (range (len (rows)), key = lambda i: self.ids[i])
+        self.sorted_ids = array.array ('L', [self.ids[i] for i in by_id])
+        self.id_positions = array.array ('L', by_id)
+
+        # article no -> positions of its headwords
+        no_positions = {}
+        for i, no in enumerate (self.nos):
+            no_positions.setdefault (no, array.array ('L')).append (i)
+        nos, self.no_offsets, self.no_positions = flatten (no_positions)
+        self.no_keys = array.array ('L', nos)
+
+        # positions in search key order, for prefix searches
+        self.key_order = array.array ('L', sorted (range (len (keys)), key = lambda i: keys[i]))
+        # the first position in wordlist order of each block of key_order
+        self.key_order_mins = array.array ('L', [
+            min (self.key_order[i:i + BLOCK]) for i in range (0, len (keys), BLOCK)
+        ])
+
+        # trigram -> sorted positions, for infix searches
+        postings = {}
+        for i, k in enumerate (keys):
+            for tri in trigrams (BOW + k + EOW):
+                postings.setdefault (tri, array.array ('L')).append (i)
+        tris, self.trigram_offsets, self.trigram_positions = flatten (postings)
+        self.trigrams = StringTable (tris)
+
+        logger.log (logging.INFO, 'HeadwordIndex: %d headwords, %d trigrams',
+                    len (self), len (self.trigrams))
+
+
+    @classmethod
+    def from_db (cls, conn, normalize = None):
+        """ Load the index from the database. """
+        res = conn.execute (text ("""
+        SELECT id, webkeyword, no, keyword, sortkeyword, n
+        FROM keyword
+        ORDER BY sortkeyword, n, no, id
+        """))
+        return cls (res, normalize)
+
+
+    def save (self, path):
+        """Save the index to a file that load () can memory-map.
+
+        The file is: MAGIC, the length of the directory, the directory in JSON,
+        and the buffers, each aligned to 8 bytes.  The new file replaces the old
+        one atomically.
+
+        """
+        buffers = [('keys', self.keys.encode ('utf-8'))]
+        for name in self.ARRAYS:
+            buffers.append ((name, getattr (self, name)))
+        for name in self.STRING_TABLES:
+            table = getattr (self, name)
+            if table is not None:
+                buffers.append ((name + '.offsets', table.offsets))
+                buffers.append ((name + '.blob', table.blob))
+
+        directory = {}
+        offset = 0
+        for name, buf in buffers:
+            nbytes = memoryview (buf).nbytes
+            directory[name] = (offset, nbytes)
+            offset += (nbytes + 7) & ~7
+        header = json.dumps (directory).encode ('utf-8')
+        start = (len (MAGIC) + 8 + len (header) + 7) & ~7
+
+        path = os.path.expanduser (path)
+        # a unique name: workers starting together may all build the index
+        fd, tmp_path = tempfile.mkstemp (dir = os.path.dirname (path),
+                                         prefix = os.path.basename (path) + '.', suffix = '.tmp')
+        os.chmod (tmp_path, 0o644)
+        with os.fdopen (fd, 'wb') as fp:
+            fp.write (MAGIC)
+            fp.write (struct.pack ('<Q', len (header)))
+            fp.write (header)
+            for name, buf in buffers:
+                fp.seek (start + directory[name][0])
+                fp.write (buf)
+            fp.truncate (start + offset)
+        os.replace (tmp_path, path)
+        logger.log (logging.INFO, 'HeadwordIndex: Saved %d headwords to %s', len (self), path)
+
+
+    @classmethod
+    def load (cls, path):
+        """Memory-map an index saved by save ().
+
+        The buffers are not copied: all processes that load the same file share
+        the pages.  Only the search key string is decoded.
+
+        """
+        path = os.path.expanduser (path)
+        with open (path, 'rb') as fp:
+            mm = mmap.mmap (fp.fileno (), 0, access = mmap.ACCESS_READ)
+        if mm[:len (MAGIC)] != MAGIC:
+            raise ValueError ('%s is not a headword index' % path)
+        (header_len, ) = struct.unpack_from ('<Q', mm, len (MAGIC))
+        header_start = len (MAGIC) + 8
+        directory = json.loads (mm[header_start:header_start + header_len].decode ('utf-8'))
+        start = (header_start + header_len + 7) & ~7
+        view = memoryview (mm)
+
+        def buf (name):
+            offset, nbytes = directory[name]
+            return view[start + offset:start + offset + nbytes]
+
+        self = cls.__new__ (cls)
+        self.mmap = mm
+        self.keys = str (buf ('keys'), 'utf-8')
+        for name in cls.ARRAYS:
+            setattr (self, name, buf (name).cast ('L'))
+        for name in cls.STRING_TABLES:
+            table = None
+            if name + '.blob' in directory:
+                table = StringTable ()
+                table.offsets = buf (name + '.offsets').cast ('L')
+                table.blob = buf (name + '.blob')
+            setattr (self, name, table)
+
+        logger.log (logging.INFO, 'HeadwordIndex: Mapped %d headwords from %s', len (self), path)
+        return self
+
+
+    def __len__ (self):
+        return len (self.ids)
+
+
+    def key (self, i):
+        """ Return the search key of the headword at position i. """
+        return self.keys[self.key_offsets[i]:self.key_offsets[i + 1] - 1]
+
+
+    def row (self, i):
+        """Return the row at position i as used by make_headwords.
+
+        row is: headword_id, webkeyword, article_id, sortkeyword, n and, if
+        precomputed, text, normalized_text
+
+        """
+        if self.iso_texts is None:
+            return (self.ids[i], self.texts[i], self.nos[i], self.sortkeywords[i], self.ns[i])
+        return (self.ids[i], self.texts[i], self.nos[i], self.sortkeywords[i], self.ns[i],
+                self.iso_texts[i], self.normalized_texts[i])
+
+
+    def rows (self, positions):
+        return [self.row (i) for i in positions]
+
+
+    def position (self, _id):
+        """ Return the position of the headword with id _id or None. """
+        i = bisect.bisect_left (self.sorted_ids, _id)
+        if i < len (self.sorted_ids) and self.sorted_ids[i] == _id:
+            return self.id_positions[i]
+        return None
+
+
+    def _prefix_bounds (self, prefix):
+        """ Return the slice of key_order of all search keys starting with prefix. """
+        lo, hi = 0, len (self.key_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key (self.key_order[mid]) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+        hi = len (self.key_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key (self.key_order[mid]).startswith (prefix):
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+
+    def _prefix_range (self, prefix):
+        """ Return the positions of all search keys starting with prefix. """
+        start, end = self._prefix_bounds (prefix)
+        return sorted (self.key_order[start:end])
+
+
+    def _first_positions (self, start, end, limit):
+        """Return the limit smallest positions in key_order[start:end], sorted.
+
+        Whole blocks enter the heap with their minimum and are opened only when
+        that reaches the top, so a short prefix with many completions costs
+        little more than a long one.
+
+        """
+        first_block = -(-start // BLOCK)
+        last_block = end // BLOCK
+        if first_block >= last_block:
+            return heapq.nsmallest (limit, self.key_order[start:end])
+
+        # (position, -1) is a position, (minimum, block) an unopened block
+        heap = [(i, -1) for i in self.key_order[start:first_block * BLOCK]]
+        heap.extend ((i, -1) for i in self.key_order[last_block * BLOCK:end])
+        heap.extend (zip (self.key_order_mins[first_block:last_block], range (first_block, last_block)))
+        heapq.heapify (heap)
+
+        result = []
+        while heap and len (result) < limit:
+            i, block = heapq.heappop (heap)
+            if block < 0:
+                result.append (i)
+            else:
+                for j in self.key_order[block * BLOCK:(block + 1) * BLOCK]:
+                    heapq.heappush (heap, (j, -1))
+        return result
+
+
+    def _trigram_positions (self, tri):
+        """ Return the positions of all search keys containing the trigram. """
+        i = self.trigrams.find (tri)
+        if i is None:
+            return ()
+        return self.trigram_positions[self.trigram_offsets[i]:self.trigram_offsets[i + 1]]
+
+
+    def _no_positions (self, no):
+        """ Return the positions of the headwords of article no. """
+        i = bisect.bisect_left (self.no_keys, no)
+        if i < len (self.no_keys) and self.no_keys[i] == no:
+            return self.no_positions[self.no_offsets[i]:self.no_offsets[i + 1]]
+        return ()
+
+
+    def _trigram_candidates (self, fragments):
+        """Return the positions of all search keys containing all trigrams of
+        all fragments, or None if the fragments are too short.
+
+        """
+        tris = set ()
+        for frag in fragments:
+            tris |= trigrams (frag)
+        if not tris:
+            return None
+        lists = sorted ((self._trigram_positions (tri) for tri in tris), key = len)
+        result = set (lists[0])
+        for l in lists[1:]:
+            if not result:
+                break
+            result.intersection_update (l)
+        return sorted (result)
+
+
+    @staticmethod
+    def _page (matches, offset, limit):
+        """ Skip offset matches and return the next limit ones. """
+        end = None if limit is None else offset + limit
+        result = []
+        for n, i in enumerate (matches):
+            if end is not None and n >= end:
+                break
+            if n >= offset:
+                result.append (i)
+        return result
+
+
+    def positions_of_nos (self, nos, offset = 0, limit = None, after = -1):
+        """Return the positions of the headwords of the articles nos.
+
+        Only headwords after position `after` are considered.  Returns a list of
+        positions in wordlist order.
+
+        """
+        positions = sorted (i for no in nos for i in self._no_positions (no) if i > after)
+        return self._page (positions, offset, limit)
+
+
+    def search (self, q, offset = 0, limit = None, after = -1, nos = None):
+        """Search for headwords matching q.
+
+        q is a glob as sent by the client: '*' stands for any sequence of
+        characters, '?' for any one character.  Only headwords after position
+        `after` and, if nos is given, only headwords of the articles in nos are
+        considered.  Returns a list of positions in wordlist order.
+
+        """
+        q = fold (q.replace ('-', '').replace ('%', ''))
+        q = q.replace ('_', '?')
+        regex = re.compile ('.*'.join (
+            '.'.join (re.escape (t) for t in part.split ('?')) for part in q.split ('*')
+        ) + '$')
+
+        prefix = re.split (r'[*?]', q, 1)[0]
+        inner = re.split (r'[*?]', BOW + q + EOW)
+
+        if len (prefix) > 0:
+            candidates = self._prefix_range (prefix)
+        else:
+            candidates = self._trigram_candidates (inner)
+
+        if candidates is None:
+            # no literal long enough: scan all search keys in one pass
+            matches = [
+                bisect.bisect_right (self.key_offsets, m.start ()) - 1
+                for m in re.finditer ('^' + regex.pattern, self.keys, re.MULTILINE)
+                if self.key_offsets[after + 1] <= m.start () < len (self.keys)
+            ]
+        else:
+            matches = (i for i in candidates if i > after and regex.match (self.key (i)))
+
+        if nos is not None:
+            nos = set (nos)
+            matches = (i for i in matches if self.nos[i] in nos)
+
+        return self._page (matches, offset, limit)
+
+
+    def suggest (self, prefix, limit):
+        """Return the first limit headwords whose search keys start with prefix.
+
+        Diacritics and case are ignored.  Returns a list of positions in
+        wordlist order.
+
+        """
+        start, end = self._prefix_bounds (fold (prefix.replace ('-', '')))
+        return self._first_positions (start, end, limit)
+
+
+    def fuzzy_search (self, q, max_distance, max_candidates, offset = 0, limit = None, nos = None):
+        """Search for headwords within edit distance max_distance of q.
+
+        Diacritics and case are ignored.  The candidates are the search keys
+        sharing the most trigrams with q.  Only the best max_candidates of them
+        are compared to q, which bounds the time spent on common trigrams.
+        Returns a list of positions ordered by distance, then in wordlist order.
+
+        """
+        q = fold (q.replace ('-', ''))
+        tris = trigrams (BOW + q + EOW)
+
+        # each edit destroys at most 3 trigrams
+        min_shared = max (1, len (tris) - 3 * max_distance)
+        counts = collections.Counter ()
+        for tri in tris:
+            counts.update (self._trigram_positions (tri))
+        candidates = heapq.nsmallest (
+            max_candidates,
+            (i for i, n in counts.items () if n >= min_shared),
+            key = lambda i: (-counts[i], i))
+
+        if nos is not None:
+            nos = set (nos)
+            candidates = [i for i in candidates if self.nos[i] in nos]
+
+        matches = []
+        for i in candidates:
+            d = edit_distance (q, self.key (i), max_distance)
+            if d <= max_distance:
+                matches.append ((d, i))
+        matches.sort ()
+
+        return self._page ((i for d, i in matches), offset, limit)
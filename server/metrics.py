@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+
+"""Counters and histograms in the Prometheus text format
+
+A minimal, thread-safe replacement for the Prometheus client library.  All
+durations are measured in seconds with a monotonic clock.
+
+"""
+
+import bisect
+import threading
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS    = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+ROW_BUCKETS     = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+def escape (value):
+    return str (value).replace ('\\', r'\\').replace ('"', r'\"').replace ('\n', r'\n')
+
+
+def format_labels (labels):
+    """ Format a list of (name, value) as {name="value",...} """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join ('%s="%s"' % (name, escape (value)) for name, value in labels)
+
+
+def format_value (value):
+    if value == float ('inf'):
+        return '+Inf'
+    if isinstance (value, float) and value.is_integer ():
+        return str (int (value))
+    return repr (value)
+
+
+class Metric (object):
+    """ Base class of the metrics. """
+
+    type = 'untyped'
+
+    def __init__ (self, name, help, labelnames = ()):
+        self.name       = name
+        self.help       = help
+        self.labelnames = tuple (labelnames)
+        self.lock       = threading.Lock ()
+        self.data       = {}
+
+
+    def header (self):
+        return [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+
+
+    def render (self):
+        raise NotImplementedError
+
+
+class Counter (Metric):
+    """ A value that only goes up. """
+
+    type = 'counter'
+
+    def inc (self, *labelvalues, value = 1):
+        with self.lock:
+            self.data[labelvalues] = self.data.get (labelvalues, 0) + value
+
+
+    def render (self):
+        lines = self.header ()
+        with self.lock:
+            for labelvalues, value in sorted (self.data.items ()):
+                labels = list (zip (self.labelnames, labelvalues))
+                lines.append ('%s%s %s' % (self.name, format_labels (labels), format_value (value)))
+        return lines
+
+
+class Histogram (Metric):
+    """ Counts observations in cumulative buckets. """
+
+    type = 'histogram'
+
+    def __init__ (self, name, help, labelnames = (), buckets = LATENCY_BUCKETS):
+        super ().__init__ (name, help, labelnames)
+        self.buckets = tuple (buckets)
+
+
+    def observe (self, value, *labelvalues):
+        with self.lock:
+            entry = self.data.get (labelvalues)
+            if entry is None:
+                # counts per bucket (+Inf last), sum
+                entry = self.data[labelvalues] = [[0] * (len (self.buckets) + 1), 0]
+            entry[0][bisect.bisect_left (self.buckets, value)] += 1
+            entry[1] += value
+
+
+    def render (self):
+        lines = self.header ()
+        with self.lock:
+            for labelvalues, (counts, sum_) in sorted (self.data.items ()):
+                labels = list (zip (self.labelnames, labelvalues))
+                total = 0
+                for le, count in zip (self.buckets + (float ('inf'), ), counts):
+                    total += count
+                    lines.append ('%s_bucket%s %d' % (
+                        self.name, format_labels (labels + [('le', format_value (le))]), total))
+                lines.append ('%s_sum%s %s'   % (self.name, format_labels (labels), format_value (sum_)))
+                lines.append ('%s_count%s %d' % (self.name, format_labels (labels), total))
+        return lines
+
+
+class Callback (Metric):
+    """A metric whose values are read when rendered.
+
+    f returns an iterable of: label values tuple, value.
+
+    """
+
+    def __init__ (self, name, help, labelnames, f, type = 'gauge'):
+        super ().__init__ (name, help, labelnames)
+        self.f    = f
+        self.type = type
+
+
+    def render (self):
+        lines = self.header ()
+        for labelvalues, value in self.f ():
+            labels = list (zip (self.labelnames, labelvalues))
+            lines.append ('%s%s %s' % (self.name, format_labels (labels), format_value (value)))
+        return lines
+
+
+class Registry (object):
+    """ A collection of metrics. """
+
+    def __init__ (self):
+        self.metrics = []
+
+
+    def add (self, metric):
+        self.metrics.append (metric)
+        return metric
+
+
+    def counter (self, *args, **kwargs):
+        return self.add (Counter (*args, **kwargs))
+
+
+    def histogram (self, *args, **kwargs):
+        return self.add (Histogram (*args, **kwargs))
+
+
+    def callback (self, *args, **kwargs):
+        return self.add (Callback (*args, **kwargs))
+
+
+    def render (self):
+        """ Return all metrics in the Prometheus text format. """
+        lines = []
+        for metric in self.metrics:
+            lines.extend (metric.render ())
+        return '\n'.join (lines) + '\n'
@@ -0,0 +1,87 @@
+# -*- encoding: utf-8 -*-
+
+"""A pre-forking HTTP server
+
+The master process binds the socket and forks the workers.  Everything the
+master loaded before, eg. the memory-mapped headword index, is shared with the
+workers.  The workers accept connections on the same socket.  The master
+replaces workers that die and stops all workers on SIGINT or SIGTERM.
+
+"""
+
+import logging
+import os
+import signal
+
+
+logger = logging.getLogger ('server')
+
+
+def serve (server, workers, after_fork = None):
+    """Serve forever with workers processes.
+
+    server is a socketserver, eg. from werkzeug.serving.make_server.
+    after_fork () is called in each new worker before it serves.
+
+    """
+    # workers must not block in accept () while another worker got the connection
+    server.socket.setblocking (False)
+
+    master = os.getpid ()
+    children = set ()
+
+    def spawn ():
+        pid = os.fork ()
+        if pid == 0:
+            signal.signal (signal.SIGINT,  signal.SIG_DFL)
+            signal.signal (signal.SIGTERM, signal.SIG_DFL)
+
+            def service_actions ():
+                # called between requests: exit if the master died
+                if os.getppid () != master:
+                    os._exit (0)
+
+            server.service_actions = service_actions
+            status = 0
+            try:
+                if after_fork is not None:
+                    after_fork ()
+                server.serve_forever ()
+            except BaseException:
+                logger.exception ('prefork: worker %d failed', os.getpid ())
+                status = 1
+            finally:
+                os._exit (status)
+        children.add (pid)
+        logger.log (logging.INFO, 'prefork: started worker %d', pid)
+
+    stopping = []
+
+    def stop (signum, frame):
+        stopping.append (signum)
+        for pid in children:
+            try:
+                os.kill (pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal (signal.SIGINT,  stop)
+    signal.signal (signal.SIGTERM, stop)
+
+    for _ in range (workers):
+        spawn ()
+
+    while children:
+        try:
+            pid, status = os.wait ()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard (pid)
+        if not stopping:
+            logger.log (logging.WARNING, 'prefork: worker %d exited with status %d, restarting',
+                        pid, status)
+            spawn ()
+
+    server.server_close ()
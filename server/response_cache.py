@@ -0,0 +1,102 @@
+# -*- encoding: utf-8 -*-
+
+"""A least recently used cache with time to live"""
+
+import collections
+import threading
+import time
+
+
+class LRUCache (object):
+    """ A thread-safe LRU cache whose entries expire after ttl seconds. """
+
+    def __init__ (self, size = 1000, ttl = 3600):
+        self.size   = size
+        self.ttl    = ttl
+        self.lock   = threading.Lock ()
+        self.data   = collections.OrderedDict ()
+        self.hits   = 0
+        self.misses = 0
+
+
+    def get (self, key):
+        """ Return the value stored under key or None. """
+        with self.lock:
+            item = self.data.get (key)
+            if item is not None:
+                expires, value = item
+                if expires > time.monotonic ():
+                    self.data.move_to_end (key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return None
+
+
+    def put (self, key, value):
+        """ Store value under key.  Evict the least recently used entries. """
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.data[key] = (time.monotonic () + self.ttl, value)
+            self.data.move_to_end (key)
+            while len (self.data) > self.size:
+                self.data.popitem (last = False)
+
+
+    def clear (self):
+        with self.lock:
+            self.data.clear ()
+
+
+class Flight (object):
+    """ A call in progress. """
+
+    def __init__ (self):
+        self.event  = threading.Event ()
+        self.result = None
+        self.ok     = False
+
+
+class SingleFlight (object):
+    """Lets concurrent callers with the same key share one call.
+
+    The first caller runs the function, the others wait for its result.
+
+    """
+
+    def __init__ (self):
+        self.lock    = threading.Lock ()
+        self.flights = {}
+        self.shared  = 0
+
+
+    def do (self, key, f, timeout):
+        """Return f ()'s result and whether it was shared with another caller.
+
+        Waits at most timeout seconds for the call in progress, then calls f
+        itself.  Also calls f itself if the call in progress raised.
+
+        """
+        with self.lock:
+            flight = self.flights.get (key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight ()
+
+        if leader:
+            try:
+                flight.result = f ()
+                flight.ok = True
+                return flight.result, False
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.event.set ()
+
+        if flight.event.wait (timeout) and flight.ok:
+            with self.lock:
+                self.shared += 1
+            return flight.result, True
+        return f (), False
@@ -4,30 +4,168 @@
 """An API for the Critical Pāli Dictionary"""
 
 import argparse
+import base64
+import binascii
 import configparser
+import contextlib
 import datetime
+import functools
+import hashlib
+import itertools
 import json
 import logging
+import os
 import os.path
+import queue
 import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 
 import flask
 from flask import request, current_app
 import sqlalchemy
 from sqlalchemy.sql import text
-import flask_sqlalchemy
 
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
 from werkzeug.routing import Map, Rule
+from werkzeug.wsgi import ClosingIterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import admission
+import compression
+from headword_index import HeadwordIndex, fold
+import metrics
+from response_cache import LRUCache, SingleFlight
+import t13n
 
 LANG = 'pi-Latn-x-iso'
+SUPPORTED_LANGS_QUERY = [ LANG, 'pi-Latn-x-iast', 'pi-Latn-x-velthuis', 'pi-Deva' ]
 MAX_RESULTS = 100
+HEADWORD_BATCH = 100
+""" Rows serialized at a time in streamed headword lists. """
+EXPORT_BATCH = 1000
+""" Rows serialized at a time in the export. """
+FUZZY_MAX_CANDIDATES = 1000
+""" Headwords compared to the query in a fuzzy search. """
+SUGGEST_LIMIT = 10
+""" Default number of completions. """
 
 re_integer_arg = re.compile (r'^[0-9]+$')
+re_integer_list_arg = re.compile (r'^[0-9]+(,[0-9]+)*$')
 re_normalize_headword = re.compile (r'^[-\[\(√°~]*(?:<sup>\d+</sup>)?(.*?)[-°~\)\]]*$')
+re_whitespace = re.compile (r'\s+')
+
+logger = logging.getLogger ('server')
+
+class PoolStats (object):
+    """ Statistics of a connection pool. """
+
+    def __init__ (self, engine):
+        self.pool  = engine.pool
+        self.lock  = threading.Lock ()
+        self.checkouts          = 0
+        self.overflow_checkouts = 0
+        self.connects           = 0
+        self.invalidations      = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max   = 0.0
+
+        sqlalchemy.event.listen (engine, 'checkout',   self.on_checkout)
+        sqlalchemy.event.listen (engine, 'connect',    self.on_connect)
+        sqlalchemy.event.listen (engine, 'invalidate', self.on_invalidate)
+
+
+    def on_checkout (self, dbapi_connection, connection_record, connection_proxy):
+        overflow = getattr (self.pool, 'overflow', None)
+        with self.lock:
+            self.checkouts += 1
+            if overflow is not None and overflow () > 0:
+                self.overflow_checkouts += 1
+
+
+    def on_connect (self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+
+    def on_invalidate (self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+
+    def waited (self, seconds):
+        """ Record the time spent waiting for a connection. """
+        with self.lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max (self.wait_seconds_max, seconds)
+
+
+    def as_dict (self):
+        stats = {
+            'checkouts'          : self.checkouts,
+            'overflow_checkouts' : self.overflow_checkouts,
+            'connects'           : self.connects,
+            'invalidations'      : self.invalidations,
+            'wait_seconds_total' : self.wait_seconds_total,
+            'wait_seconds_max'   : self.wait_seconds_max,
+        }
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            f = getattr (self.pool, name, None)
+            if f is not None:
+                stats[name] = f ()
+        return stats
+
+
+class Engine (object):
+    """ Database Interface base class """
+
+    has_fulltext = False
+    """ The database can do MATCH ... AGAINST """
+
+    def init_stats (self):
+        self.stats = PoolStats (self.engine)
+
 
-class MySQLEngine (object):
+    @contextlib.contextmanager
+    def begin (self):
+        """ Like engine.begin () but records the time spent waiting for the pool. """
+        start_time = time.monotonic ()
+        with self.engine.begin () as conn:
+            self.stats.waited (time.monotonic () - start_time)
+            yield conn
+
+
+    @contextlib.contextmanager
+    def connect (self):
+        """ Like engine.connect () but records the time spent waiting for the pool. """
+        start_time = time.monotonic ()
+        with self.engine.connect () as conn:
+            self.stats.waited (time.monotonic () - start_time)
+            yield conn
+
+
+    def explain (self, conn, sql, parameters):
+        """Return the query plan of sql.
+
+        Returns a list of: step, problem.  problem is None, 'full scan' or
+        'filesort'.
+
+        """
+        raise NotImplementedError
+
+
+class MySQLEngine (Engine):
     """ Database Interface """
 
+    has_fulltext = True
+
     def __init__ (self, **kwargs):
 
         args = self.get_connection_params (kwargs)
@@ -36,7 +174,12 @@ class MySQLEngine (object):
         logger.log (logging.INFO,
                     'MySQLEngine: Connecting to mysql+pymysql://{user}:password@{host}:{port}/{database}'.format (**args))
         self.engine = sqlalchemy.create_engine (self.url + '?charset=utf8mb4&sql_mode=ANSI',
-                                                pool_recycle = 300)
+                                                pool_size     = kwargs.get ('MYSQL_POOL_SIZE', 5),
+                                                max_overflow  = kwargs.get ('MYSQL_MAX_OVERFLOW', 10),
+                                                pool_timeout  = kwargs.get ('MYSQL_POOL_TIMEOUT', 30),
+                                                pool_recycle  = kwargs.get ('MYSQL_POOL_RECYCLE', 300),
+                                                pool_pre_ping = kwargs.get ('MYSQL_POOL_PRE_PING', True))
+        self.init_stats ()
 
 
     def get_connection_params (self, kwargs = {}):
@@ -61,14 +204,175 @@ class MySQLEngine (object):
         return from_my_cnf
 
 
-def execute (conn, sql, parameters, debug_level = logging.DEBUG):
-    start_time = datetime.datetime.now ()
+    def like_key (self, q):
+        """ Convert a LIKE pattern to match the keyword column. """
+        # the column collation ignores case and diacritics
+        return q
+
+
+    def explain (self, conn, sql, parameters):
+        plan = []
+        for row in conn.execute (text ('EXPLAIN ' + sql.strip ()), parameters).mappings ():
+            table = row.get ('table') or ''
+            extra = row.get ('Extra') or ''
+            step = '%s: type=%s key=%s rows=%s %s' % (
+                table, row.get ('type'), row.get ('key'), row.get ('rows'), extra)
+            problem = None
+            # derived tables are small, eg. the halves of the context query
+            if not table.startswith ('<'):
+                if row.get ('type') == 'ALL':
+                    problem = 'full scan'
+                elif row.get ('type') == 'index':
+                    problem = 'full index scan'
+                elif 'Using filesort' in extra:
+                    problem = 'filesort'
+            plan.append ((step.strip (), problem))
+        return plan
+
+
+class SQLiteEngine (Engine):
+    """Embedded read-only Database Interface
+
+    Reads an SQLite file made with: server.py --export-sqlite.  The keyword
+    column in the file is folded, see: headword_index.fold ().
+
+    """
+
+    def __init__ (self, **kwargs):
+
+        path = os.path.expanduser (kwargs['SQLITE_FILE'])
+
+        self.url = 'sqlite:///' + path
+        logger.log (logging.INFO, 'SQLiteEngine: Opening %s', path)
+        self.engine = sqlalchemy.create_engine ('sqlite:///file:%s?mode=ro&uri=true' % path)
+        self.init_stats ()
+
+
+    def like_key (self, q):
+        """ Convert a LIKE pattern to match the keyword column. """
+        return fold (q)
+
+
+    def explain (self, conn, sql, parameters):
+        plan = []
+        subqueries = set ()
+        for row in conn.execute (text ('EXPLAIN QUERY PLAN ' + sql.strip ()), parameters):
+            step = row[-1]
+            m = re.match (r'(?:CO-ROUTINE|MATERIALIZE) (\w+)', step)
+            if m:
+                subqueries.add (m.group (1))
+            problem = None
+            m = re.match (r'SCAN (\w+)( USING (?:COVERING )?INDEX)?', step)
+            if m and m.group (1) not in subqueries:
+                problem = 'full index scan' if m.group (2) else 'full scan'
+            elif step.startswith ('USE TEMP B-TREE FOR ORDER BY'):
+                problem = 'filesort'
+            plan.append ((step, problem))
+        return plan
+
+
+ENGINES = {
+    'mysql'  : MySQLEngine,
+    'sqlite' : SQLiteEngine,
+}
+
+
+def record_statement (statement, seconds, rowcount):
+    """ Record the latency and row count of the SQL statement named statement. """
+    m = current_app.config.metrics
+    labels = (request.endpoint if flask.has_request_context () else '', statement)
+    m.sql_seconds.observe (seconds, *labels)
+    if rowcount >= 0:
+        m.sql_rows.observe (rowcount, *labels)
+
+
+def execute (conn, statement, sql, parameters, debug_level = logging.DEBUG):
+    """ Execute sql.  statement is the name of the statement in the metrics. """
+    start_time = time.monotonic ()
     result = conn.execute (text (sql.strip ()), parameters)
-    logger.log (debug_level, '%d rows in %.3fs',
-                result.rowcount, (datetime.datetime.now () - start_time).total_seconds ())
+    seconds = time.monotonic () - start_time
+    logger.log (debug_level, '%d rows in %.3fs', result.rowcount, seconds)
+    record_statement (statement, seconds, -1 if conn.get_execution_options ().get ('stream_results')
+                      else result.rowcount)
+    log_slow_query (statement, sql, parameters, seconds)
     return result
 
 
+def shorten (s, length):
+    """ Cut s to length characters for the log. """
+    return s if len (s) <= length else s[:length] + '...'
+
+
+def log_slow_query (statement, sql, parameters, seconds):
+    """Log a statement that took SLOW_QUERY_SECONDS or longer, with its plan.
+
+    The plans are kept by statement name for a while, so that a burst of slow
+    queries does not double the load.  A new plan is explained by a background
+    thread on its own connection: the caller still holds its connection, and
+    under load the pool may have no other to give.
+
+    """
+    config = current_app.config
+    threshold = config.get ('SLOW_QUERY_SECONDS', 1.0)
+    if threshold <= 0 or seconds < threshold:
+        return
+
+    message = 'Slow query: %s: %.3fs: %s %s' % (
+        statement, seconds, shorten (re_whitespace.sub (' ', sql.strip ()), 500),
+        shorten (repr (parameters), 200))
+    plan = config.query_plans.get (statement)
+    if plan is not None:
+        logger.log (logging.WARNING, '%s\n  %s', message, '\n  '.join (plan))
+        return
+
+    try:
+        config.slow_queries.put_nowait ((statement, sql, parameters, message))
+    except queue.Full:
+        logger.log (logging.WARNING, message)
+        return
+    with config.explain_lock:
+        if config.explain_thread is None or not config.explain_thread.is_alive ():
+            config.explain_thread = threading.Thread (
+                target = explain_slow_queries, args = (current_app._get_current_object (), ),
+                name = 'explain', daemon = True)
+            config.explain_thread.start ()
+
+
+def explain_slow_queries (app):
+    """ Thread.  Explain and log the slow queries queued by log_slow_query (). """
+    while True:
+        statement, sql, parameters, message = app.config.slow_queries.get ()
+        with app.app_context ():
+            plan = app.config.query_plans.get (statement)
+            if plan is None:
+                dba = app.config.dba
+                try:
+                    with dba.connect () as conn:
+                        plan = [step for step, problem in dba.explain (conn, sql, parameters)]
+                except sqlalchemy.exc.SQLAlchemyError as e:
+                    plan = ['EXPLAIN failed: %s' % shorten (str (e), 500)]
+                app.config.query_plans.put (statement, plan)
+            logger.log (logging.WARNING, '%s\n  %s', message, '\n  '.join (plan))
+
+
+def execute_streamed (statement, sql, parameters):
+    """Execute a query and yield the rows as they come off the server-side
+    cursor.
+
+    The connection stays open until the generator is exhausted.  Must run
+    inside an application context, see: flask.stream_with_context.
+
+    """
+    with current_app.config.dba.connect () as conn:
+        res = execute (conn.execution_options (stream_results = True), statement, sql, parameters)
+        rowcount = 0
+        for row in res:
+            rowcount += 1
+            yield row
+        current_app.config.metrics.sql_rows.observe (
+            rowcount, request.endpoint if flask.has_request_context () else '', statement)
+
+
 def clip (i, min_, max_):
     return max (min (int (i), max_), min_)
 
@@ -78,10 +382,43 @@ def arg (name, default, regex, msg = None):
     if not regex.match (arg):
         if msg is None:
             msg = 'Invalid %s parameter' % name
-        flask.abort (msg)
+        flask.abort (400, msg)
     return arg
 
 
+def t13n_arg ():
+    """ Get the transliteration of the query from the lang parameter. """
+    lang = request.args.get ('lang')
+    if not lang:
+        return t13n.ISO
+    scheme = t13n.parse_lang (lang)
+    if scheme not in t13n.SUPPORTED:
+        flask.abort (400, 'Unsupported lang parameter')
+    return scheme
+
+
+def ids_arg ():
+    """ Get the ids parameter as a list of at most MAX_RESULTS integers. """
+    ids = arg ('ids', '', re_integer_list_arg)
+    return [int (i) for i in ids.split (',')][:MAX_RESULTS]
+
+
+def in_list (name, values):
+    """Build the SQL list and the parameters for an IN clause.
+
+    Returns eg. '(:id0, :id1)', { 'id0' : 42, 'id1' : 43 }
+
+    """
+    params = { '%s%d' % (name, n) : v for n, v in enumerate (values) }
+    return '(%s)' % ', '.join (':' + k for k in params), params
+
+
+def in_request_order (rows, ids, key = lambda row: row[0]):
+    """ Sort rows in the order of ids.  Drop the ids not found. """
+    by_id = { key (row) : row for row in rows }
+    return [by_id[i] for i in ids if i in by_id]
+
+
 cpd_iso_trans = str.maketrans ('âêîôû', 'aeiou')
 
 def normalize_iso (text):
@@ -98,53 +435,360 @@ def normalize_iso (text):
     return text.translate (cpd_iso_trans)
 
 
-def make_headword (row, lang = LANG):
-    """ row is: headword_id, text, article_id """
-    normalized = text = normalize_iso (row[1])
-    m = re_normalize_headword.match (normalized)
-    if m:
-        normalized = m.group (1).lower ()
-    return {
-        'articles_url' : 'v1/articles/%d' % row[2],
-        'headwords_url' : 'v1/headwords/%d' % row[0],
-        'lang' : lang,
-        'normalized_text' : normalized,
-        'text' : text,
-    }
+@functools.lru_cache (maxsize = 1 << 17)
+def normalize_headword (webkeyword):
+    """ Return the display text and the normalized text of a headword. """
+    text = normalize_iso (webkeyword)
+    m = re_normalize_headword.match (text)
+    return text, (m.group (1).lower () if m else text)
 
 
-def make_json_response (obj):
-    resp = flask.Response (json.dumps (obj, indent=2, sort_keys=True), mimetype='application/json')
+def make_headwords (rows, lang = LANG):
+    """Build the headword objects for a batch of rows.
+
+    rows are: headword_id, webkeyword, article_id [, sortkeyword, n [, text,
+    normalized_text]].  text and normalized_text are computed unless
+    precomputed, see: HeadwordIndex.
+
+    """
+    result = []
+    append = result.append
+    for row in rows:
+        if len (row) > 6:
+            text, normalized = row[5], row[6]
+        else:
+            text, normalized = normalize_headword (row[1])
+        append ({
+            'articles_url' : 'v1/articles/%d' % row[2],
+            'headwords_url' : 'v1/headwords/%d' % row[0],
+            'lang' : lang,
+            'normalized_text' : normalized,
+            'text' : text,
+        })
+    return result
+
+
+def encode_cursor (key):
+    """ Encode the sort key of the last row seen into an opaque token. """
+    return base64.urlsafe_b64encode (json.dumps (key).encode ('utf-8')).decode ('ascii')
+
+
+def cursor_arg (types, name = 'cursor'):
+    """Decode the cursor parameter.
+
+    types are the types of the elements of the sort key.  Returns the sort key
+    of the last row seen on the previous page or None.
+
+    """
+    token = request.args.get (name)
+    if not token:
+        return None
+    try:
+        key = json.loads (base64.urlsafe_b64decode (token.encode ('ascii')).decode ('utf-8'))
+    except (ValueError, binascii.Error):
+        key = None
+    if (not isinstance (key, list) or len (key) != len (types)
+            or not all (isinstance (k, t) for k, t in zip (key, types))):
+        flask.abort (400, 'Invalid %s parameter' % name)
+    return key
+
+
+def keyset_condition (columns, values, op = '>', last_op = None):
+    """Build the SQL condition (columns) op (values) for a row of columns.
+
+    The row comparison is expanded into: c1 op v1 OR (c1 = v1 AND (c2 op v2
+    OR ...)), because the MySQL range optimizer cannot seek an index on a
+    row-constructor inequality.  last_op, eg. '>=', replaces op for the last
+    column.
+
+    """
+    last_op = last_op or op
+    cond = '%s %s %s' % (columns[-1], last_op, values[-1])
+    for c, v in reversed (list (zip (columns[:-1], values[:-1]))):
+        cond = '%s %s %s OR (%s = %s AND (%s))' % (c, op, v, c, v, cond)
+    if len (columns) == 1:
+        return cond
+    # the redundant first term gives the optimizer a plain range
+    return '%s %s= %s AND (%s)' % (columns[0], op, values[0], cond)
+
+
+def keyset (cursor, columns, prefix = ''):
+    """Build the SQL condition that skips all rows up to and including the
+    cursor.
+
+    This turns a deep OFFSET scan into an index range seek.
+
+    """
+    if cursor is None:
+        return '1 = 1', {}
+    params = { 'cursor_%s' % c : v for c, v in zip (columns, cursor) }
+    return keyset_condition ([prefix + c for c in columns],
+                             [':cursor_%s' % c for c in columns]), params
+
+
+HEADWORD_KEYSET = ('sortkeyword', 'n', 'no', 'id')
+ARTICLE_KEYSET  = ('no', )
+
+HEADWORD_KEYSET_TYPES = (str, int, int, int)
+ARTICLE_KEYSET_TYPES  = (int, )
+
+
+def serialize (obj, pretty = False):
+    """Serialize obj to JSON.
+
+    Compact by default.  Uses orjson if installed.  Returns bytes.
+
+    """
+    if orjson is not None:
+        return orjson.dumps (obj, option = orjson.OPT_SORT_KEYS |
+                             (orjson.OPT_INDENT_2 if pretty else 0))
+    if pretty:
+        return json.dumps (obj, indent=2, sort_keys=True).encode ('utf-8')
+    return json.dumps (obj, separators=(',', ':'), sort_keys=True).encode ('utf-8')
+
+
+def is_pretty ():
+    """ Return True if the client asked for pretty-printed JSON. """
+    return request.args.get ('pretty', '0') not in ('', '0')
+
+
+def make_raw_json_response (body):
+    """ Make a response from an already serialized body or a generator. """
+    resp = flask.Response (body, mimetype='application/json')
     resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
 
-def make_headwords_response (res, limit = MAX_RESULTS, lang = LANG):
-    return make_json_response ({
-        'limit' : limit,
-        'data' : [ make_headword (row, lang) for row in res ]
-    })
+def make_json_response (obj):
+    return make_raw_json_response (serialize (obj, is_pretty ()))
+
+
+def make_headwords_response (res, limit = MAX_RESULTS, lang = LANG, paged = False):
+    """Build the response envelope for a list of headwords.
+
+    If paged is set, the rows must be: headword_id, text, article_id,
+    sortkeyword, n, and a cursor to the next page is included if the page is
+    full.
+
+    Unless the client asked for pretty-printed JSON, the response is streamed:
+    each row is serialized as it comes off the iterator res.
+
+    """
+    if is_pretty ():
+        res = list (res)
+        obj = {
+            'limit' : limit,
+            'data' : make_headwords (res, lang)
+        }
+        if paged and len (res) >= limit:
+            last = res[-1]
+            obj['next'] = encode_cursor ([last[3], last[4], last[2], last[0]])
+        return make_json_response (obj)
+
+    def generate ():
+        # keys in sorted order, same as serialize ()
+        yield b'{"data":['
+        count = 0
+        last = None
+        it = iter (res)
+        while True:
+            batch = list (itertools.islice (it, HEADWORD_BATCH))
+            if not batch:
+                break
+            if count:
+                yield b','
+            # serialize the whole batch and strip the brackets
+            yield serialize (make_headwords (batch, lang))[1:-1]
+            count += len (batch)
+            last = batch[-1]
+        yield b'],"limit":%d' % limit
+        if paged and count >= limit:
+            yield b',"next":' + serialize (encode_cursor ([last[3], last[4], last[2], last[0]]))
+        yield b'}'
+
+    return make_raw_json_response (flask.stream_with_context (generate ()))
+
+
+def cached (f):
+    """Decorator.  Cache the responses of an endpoint.
+
+    The cache key is the endpoint, its arguments and the normalized query
+    arguments.  The data version is part of the key, so that a reimport of the
+    data invalidates all entries.
+
+    Adds cache validators to the response and answers conditional requests with
+    304 Not Modified.
+
+    Concurrent requests with the same key share one call of the endpoint and
+    one serialized response.  They wait at most SINGLE_FLIGHT_TIMEOUT seconds
+    for it.
+
+    """
+
+    @functools.wraps (f)
+    def wrapper (*args, **kwargs):
+        cache = current_app.config.response_cache
+        timeout = current_app.config.get ('SINGLE_FLIGHT_TIMEOUT', 5)
+        if cache.size <= 0 and timeout <= 0:
+            # do not buffer streamed responses
+            return f (*args, **kwargs)
+
+        key = cache_key (kwargs)
+        hit = cache.get (key) if cache.size > 0 else None
+        if hit is None:
+
+            def load ():
+                resp = f (*args, **kwargs)
+                if resp.status_code != 200:
+                    return resp
+                entry = cache_entry (resp)
+                cache.put (key, entry)
+                return entry
+
+            if timeout > 0:
+                hit, shared = current_app.config.single_flight.do (key, load, timeout)
+            else:
+                hit, shared = load (), False
+            if not isinstance (hit, CacheEntry):
+                # error responses belong to the request that made them
+                return f (*args, **kwargs) if shared else hit
+
+        return response_from_cache (hit)
+
+    return wrapper
+
+
+def cache_key (view_args):
+    """ Build the cache key of the current request. """
+    return (
+        current_app.config['server_start_time'],
+        request.endpoint,
+        tuple (sorted (view_args.items ())),
+        tuple (sorted (request.args.items (multi = True))),
+    )
+
+
+class CacheEntry (object):
+    """A cached response.
 
+    The compressed bodies are added as clients ask for them, so that each body
+    is compressed at most once per encoding.
 
-# need this before first @app.endpoint declaration
-app = flask.Flask (__name__)
+    """
+
+    def __init__ (self, body, status, headers):
+        self.body    = body
+        self.status  = status
+        self.headers = headers
+        self.encoded = {}
+
+
+    def encode (self, encoding):
+        """ Return the body compressed with encoding. """
+        body = self.encoded.get (encoding)
+        if body is None:
+            body = self.encoded[encoding] = compression.compress (encoding, self.body)
+        return body
+
+
+def cache_entry (resp):
+    """ Add the cache validators to resp and return the entry to cache. """
+    resp.set_etag (hashlib.sha1 (resp.get_data ()).hexdigest ())
+    resp.last_modified = current_app.config['server_start_datetime']
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.config.get ('CACHE_MAX_AGE', 3600)
+    return CacheEntry (resp.get_data (), resp.status_code, list (resp.headers.items ()))
+
+
+def response_from_cache (entry):
+    """Build the response from a cache entry.
+
+    Sends the compressed body if the client accepts it.  Answers conditional
+    requests.
+
+    """
+    resp = flask.Response (entry.body, entry.status, entry.headers)
+    encoding = response_encoding (resp)
+    if encoding is not None:
+        resp.set_data (entry.encode (encoding))
+        set_encoding (resp, encoding)
+    return resp.make_conditional (request)
+
+
+COMPRESSIBLE_MIMETYPES = { 'application/json', 'application/x-ndjson', 'text/plain', 'text/html' }
+
+
+def response_encoding (resp):
+    """Choose the content encoding for resp.
+
+    Returns None if resp should be sent as is.  Adds Vary: Accept-Encoding if
+    the choice depends on the request.  Bodies shorter than COMPRESS_MIN_SIZE
+    are not compressed.  Streamed bodies are always compressed.
+
+    """
+    if resp.content_encoding or resp.status_code in (204, 304) or resp.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return None
+    if not resp.is_streamed and resp.content_length < current_app.config.get ('COMPRESS_MIN_SIZE', 1024):
+        return None
+    resp.vary.add ('Accept-Encoding')
+    return compression.negotiate (request.accept_encodings)
+
+
+def set_encoding (resp, encoding):
+    """ Set the headers of a body compressed with encoding. """
+    resp.content_encoding = encoding
+    etag, weak = resp.get_etag ()
+    if etag:
+        # the compressed body is another representation
+        resp.set_etag ('%s-%s' % (etag, encoding), weak)
+
+
+def compress_response (resp):
+    """ Compress the body of resp if the client accepts it. """
+    encoding = response_encoding (resp)
+    if encoding is None:
+        return resp
+    if resp.is_streamed:
+        chunks = resp.response
+        # close the original iterable too, to release the request context
+        resp.response = ClosingIterator (compression.compress_chunks (encoding, chunks),
+                                         getattr (chunks, 'close', None))
+    else:
+        resp.set_data (compression.compress (encoding, resp.get_data ()))
+    set_encoding (resp, encoding)
+    return resp
+
+
+VIEWS = {}
+""" The view functions by endpoint, see: create_app """
 
-@app.endpoint ('info')
+
+def endpoint (name):
+    """ Decorator.  Register a view function for the endpoint name. """
+    def decorator (f):
+        VIEWS[name] = f
+        return f
+    return decorator
+
+
+@endpoint ('info')
+@cached
 def info ():
     """ Endpoint.  The root of the application. """
 
     info = {
-        'name'          : app.config['APPLICATION_NAME'],
-        'short_name'    : app.config['APPLICATION_SHORT_NAME'],
-        'main_page_url' : app.config['APPLICATION_MAIN_URL'],
-        # 'css_url'       : app.config.get ('APPLICATION_CSS_URL', ''),
+        'name'          : current_app.config['APPLICATION_NAME'],
+        'short_name'    : current_app.config['APPLICATION_SHORT_NAME'],
+        'main_page_url' : current_app.config['APPLICATION_MAIN_URL'],
+        # 'css_url'       : current_app.config.get ('APPLICATION_CSS_URL', ''),
         'css'           : 'span.smalltext { font-size: smaller }',
-        'supported_langs_query' : [ LANG ],
+        'supported_langs_query' : SUPPORTED_LANGS_QUERY,
     }
     return make_json_response (info)
 
 
-@app.endpoint ('headwords')
+@endpoint ('headwords')
+@cached
 def headwords ():
     """ Endpoint.  Retrieve a list of headword IDs.
 
@@ -152,24 +796,137 @@ def headwords ():
 
     """
 
+    if 'ids' in request.args:
+        return headwords_ids ()
+
+    q, fulltext, offset, limit, cursor = headwords_args ()
+    nos = fulltext_nos (fulltext)
+
+    if fuzzy_arg ():
+        return headwords_fuzzy (q, fulltext, nos, offset, limit)
+
+    resp = headwords_from_index (q, fulltext, nos, offset, limit, cursor)
+    if resp is not None:
+        return resp
+
+    statement, sql, params = headwords_sql (q, fulltext, offset, limit, cursor)
+    return make_headwords_response (execute_streamed (statement, sql, params), limit, paged = True)
+
+
+def headwords_args ():
+    """ Parse the arguments of the headwords endpoint.
+
+    Returns: q, fulltext, offset, limit, cursor.  q and fulltext are converted
+    to ISO 15919.
+
+    """
+
     q        = request.args.get ('q')
     fulltext = request.args.get ('fulltext')
     offset   = int (arg ('offset', '0', re_integer_arg))
     limit    = clip (arg ('limit', str (MAX_RESULTS), re_integer_arg), 1, MAX_RESULTS)
-    where    = ''
+    cursor   = cursor_arg (HEADWORD_KEYSET_TYPES)
+    scheme   = t13n_arg ()
 
-    if (not q) and (not fulltext):
+    if q:
+        q = t13n.to_iso (q, scheme)
+    if fulltext:
+        fulltext = t13n.to_iso (fulltext, scheme)
+
+    return q, fulltext, offset, limit, cursor
+
+
+def fulltext_nos (fulltext):
+    """ Return the article nos found by the full-text index.
+
+    Returns None if there is no full-text query or no full-text index.
+
+    """
+    fti = current_app.config.fulltext_index
+    if fulltext and fti is not None:
+        return fti.search (fulltext)
+    return None
+
+
+def fuzzy_arg ():
+    """ Return True if the client asked for a fuzzy search. """
+    return request.args.get ('fuzzy', '0') not in ('', '0')
+
+
+def headwords_fuzzy (q, fulltext, nos, offset, limit):
+    """Answer a fuzzy headwords query from the headword index.
+
+    Finds the headwords within a small edit distance of q, ignoring diacritics.
+    The best matches come first.  Never falls back to the database.
+
+    """
+    hwi = current_app.config.hwi
+
+    if hwi is None:
+        flask.abort (400, 'This server does not support fuzzy searches')
+    if not q:
+        flask.abort (400, 'The fuzzy parameter needs a q parameter')
+    if fulltext and nos is None:
+        flask.abort (400, 'This server does not support fuzzy searches with fulltext')
+
+    q = re.sub (r'[*?%_]', '', q)
+    max_distance = 1 if len (q) <= 4 else 2
+    positions = hwi.fuzzy_search (q, max_distance, FUZZY_MAX_CANDIDATES, offset, limit, nos)
+
+    return make_headwords_response (hwi.rows (positions), limit)
+
+
+def headwords_from_index (q, fulltext, nos, offset, limit, cursor):
+    """ Answer the headwords query from the headword index.
+
+    Returns None if the index cannot answer the query.
+
+    """
+    hwi = current_app.config.hwi
+
+    if hwi is None or (fulltext and nos is None):
+        return None
+
+    # Start after the position of the last headword seen.
+    after = -1
+    if cursor is not None:
+        after = hwi.position (cursor[3])
+        if after is None:
+            flask.abort (400, 'Invalid cursor parameter')
+
+    if q:
+        positions = hwi.search (q, offset, limit, after, nos)
+    elif nos is not None:
+        positions = hwi.positions_of_nos (nos, offset, limit, after)
+    else:
         # Retrieve full list of headwords
-        with current_app.config.dba.engine.begin () as conn:
-            res = execute (conn, r"""
-            SELECT id, webkeyword, no
-            FROM keyword
-            ORDER BY sortkeyword, n, no
-            LIMIT :limit
-            OFFSET :offset
-            """, { 'offset' : offset, 'limit' : limit })
+        start = after + 1 + offset
+        positions = range (start, min (start + limit, len (hwi)))
 
-        return make_headwords_response (res, limit)
+    return make_headwords_response (hwi.rows (positions), limit, paged = True)
+
+
+def headwords_sql (q, fulltext, offset, limit, cursor):
+    """ Build the SQL query for the headwords endpoint.
+
+    Returns: statement name, sql, parameters.
+
+    """
+    where = ''
+
+    keyset_where, params = keyset (cursor, HEADWORD_KEYSET)
+    params.update ({ 'offset' : offset, 'limit' : limit })
+
+    if (not q) and (not fulltext):
+        # Retrieve full list of headwords
+        return 'headwords', r"""
+        SELECT id, webkeyword, no, sortkeyword, n
+        FROM keyword
+        WHERE {keyset}
+        ORDER BY sortkeyword, n, no, id
+        LIMIT :limit
+        OFFSET :offset
+        """.format (keyset = keyset_where), params
 
     if q:
         q = q.replace ('-', '')
@@ -178,89 +935,153 @@ def headwords ():
         q = q.replace ('*', '%')
         where = "(keyword LIKE :q) AND"
 
+    params['q'] = current_app.config.dba.like_key (q) if q else q
+
     if not fulltext:
         # easy out
-        with current_app.config.dba.engine.begin () as conn:
-            res = execute (conn, r"""
-            SELECT id, webkeyword, no
-            FROM keyword
-            WHERE keyword LIKE :q
-            ORDER BY sortkeyword, n, no
-            LIMIT :limit
-            OFFSET :offset
-            """, { 'q' : q, 'offset' : offset, 'limit' : limit })
-
-        return make_headwords_response (res, limit)
-
-    with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, r"""
-        SELECT DISTINCT
-           k.id,
-           k.webkeyword COLLATE utf8mb4_bin AS webkeyword,
-           k.no
-        FROM keyword k,
-             article a
-        WHERE {where} (MATCH (a.idxtext) AGAINST (:fulltext IN BOOLEAN MODE))
-        AND a.no = k.no
-        ORDER BY k.sortkeyword, k.n, k.no
+        return 'headwords q', r"""
+        SELECT id, webkeyword, no, sortkeyword, n
+        FROM keyword
+        WHERE keyword LIKE :q
+        AND {keyset}
+        ORDER BY sortkeyword, n, no, id
         LIMIT :limit
         OFFSET :offset
-        """.format (where = where), { 'q' : q, 'fulltext' : fulltext,
-                                      'offset' : offset, 'limit' : limit })
+        """.format (keyset = keyset_where), params
+
+    if not current_app.config.dba.has_fulltext:
+        flask.abort (400, 'This server does not support full-text searches')
+
+    keyset_where, params = keyset (cursor, HEADWORD_KEYSET, 'k.')
+    params.update ({ 'q' : q, 'fulltext' : fulltext, 'offset' : offset, 'limit' : limit })
+
+    return 'headwords fulltext', r"""
+    SELECT DISTINCT
+       k.id,
+       k.webkeyword COLLATE utf8mb4_bin AS webkeyword,
+       k.no,
+       k.sortkeyword,
+       k.n
+    FROM keyword k,
+         article a
+    WHERE {where} (MATCH (a.idxtext) AGAINST (:fulltext IN BOOLEAN MODE))
+    AND a.no = k.no
+    AND {keyset}
+    ORDER BY k.sortkeyword, k.n, k.no, k.id
+    LIMIT :limit
+    OFFSET :offset
+    """.format (where = where, keyset = keyset_where), params
+
+
+def headwords_ids ():
+    """ Retrieve many headwords by id in one request. """
+
+    ids = ids_arg ()
+    hwi = current_app.config.hwi
+
+    if hwi is not None:
+        positions = [hwi.position (i) for i in ids]
+        return make_headwords_response (hwi.rows (p for p in positions if p is not None))
+
+    sql_ids, params = in_list ('id', ids)
+
+    with current_app.config.dba.begin () as conn:
+        res = execute (conn, 'headwords ids', """
+        SELECT id, webkeyword, no
+        FROM keyword
+        WHERE id IN {ids}
+        """.format (ids = sql_ids), params)
 
-        return make_headwords_response (res, limit)
+        return make_headwords_response (in_request_order (res, ids))
+
+
+@endpoint ('headwords_suggest')
+@cached
+def headwords_suggest ():
+    """ Endpoint.  Complete a prefix to headwords, for typeahead. """
+
+    prefix = request.args.get ('prefix')
+    if not prefix:
+        flask.abort (400, 'Missing prefix parameter')
+    prefix = t13n.to_iso (prefix, t13n_arg ())
+    limit  = clip (arg ('limit', str (SUGGEST_LIMIT), re_integer_arg), 1, MAX_RESULTS)
+
+    hwi = current_app.config.hwi
+    if hwi is not None:
+        return make_headwords_response (hwi.rows (hwi.suggest (prefix, limit)), limit)
 
+    statement, sql, params = headwords_sql (prefix.replace ('*', '').replace ('?', '') + '*',
+                                            None, 0, limit, None)
+    return make_headwords_response (execute_streamed (statement, sql, params), limit)
 
-@app.endpoint ('headwords_id')
+
+@endpoint ('headwords_id')
+@cached
 def headwords_id (_id):
     """ Retrieve a headword. """
 
-    with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, """
+    with current_app.config.dba.begin () as conn:
+        res = execute (conn, 'headword', """
         SELECT id, webkeyword, no
         FROM keyword
         WHERE id = :id
         """, { 'id' : _id })
 
-        return make_headwords_response (res)
-
-
-@app.endpoint ('headwords_id_context')
+        return make_headwords_response (res.fetchall ())
+
+
+CONTEXT_SQL = """
+SELECT id, webkeyword, no
+FROM (
+  SELECT * FROM (
+    SELECT k.id, k.webkeyword, k.no, k.sortkeyword, k.n
+    FROM keyword k, keyword h
+    WHERE h.id = :id
+    AND {lo}
+    ORDER BY k.sortkeyword DESC, k.n DESC, k.no DESC, k.id DESC
+    LIMIT :limit
+  ) AS lo
+  UNION ALL
+  SELECT * FROM (
+    SELECT k.id, k.webkeyword, k.no, k.sortkeyword, k.n
+    FROM keyword k, keyword h
+    WHERE h.id = :id
+    AND {hi}
+    ORDER BY k.sortkeyword, k.n, k.no, k.id
+    LIMIT :limit1
+  ) AS hi
+) AS context
+ORDER BY sortkeyword, n, no, id
+""".format (
+    lo = keyset_condition (['k.' + c for c in HEADWORD_KEYSET], ['h.' + c for c in HEADWORD_KEYSET], '<'),
+    hi = keyset_condition (['k.' + c for c in HEADWORD_KEYSET], ['h.' + c for c in HEADWORD_KEYSET], '>', '>='),
+)
+""" The limit headwords before the headword, the headword, and the limit
+headwords after it. """
+
+
+@endpoint ('headwords_id_context')
+@cached
 def headwords_id_context (_id):
     """ Retrieve a list of headwords around a given headword. """
 
     limit = clip (arg ('limit', str (MAX_RESULTS), re_integer_arg), 1, MAX_RESULTS)
 
-    with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, """
-        SELECT keyword, sortkeyword
-        FROM keyword
-        WHERE id = :id
-        """, { 'id' : _id })
-        keyword, sortkeyword = res.fetchone ()
+    hwi = current_app.config.hwi
 
-        res1 = execute (conn, """
-        SELECT id, webkeyword, no
-        FROM keyword
-        WHERE sortkeyword < :sortkeyword
-        ORDER BY sortkeyword DESC, n DESC, no DESC
-        LIMIT :limit
-        """, { 'sortkeyword' : sortkeyword, 'limit' : limit })
-
-        res2 = execute (conn, """
-        SELECT id, webkeyword, no
-        FROM keyword
-        WHERE sortkeyword >= :sortkeyword
-        ORDER BY sortkeyword, n, no
-        LIMIT :limit
-        """, { 'sortkeyword' : sortkeyword, 'limit' : limit + 1 })
+    if hwi is not None:
+        pos = hwi.position (_id)
+        if pos is None:
+            flask.abort (404)
+        positions = range (max (pos - limit, 0), min (pos + limit + 1, len (hwi)))
+        return make_headwords_response (hwi.rows (positions), limit)
 
-        res = []
+    with current_app.config.dba.begin () as conn:
+        res = execute (conn, 'headword context', CONTEXT_SQL, { 'id' : _id, 'limit' : limit, 'limit1' : limit + 1 })
 
-        for row in reversed (res1.fetchall ()):
-            res.append (row[:3])
-        for row in res2:
-            res.append (row[:3])
+        res = res.fetchall ()
+        if not res:
+            flask.abort (404)
 
         return make_headwords_response (res, limit)
 
@@ -272,38 +1093,54 @@ def make_article (row, lang = LANG):
     }
 
 
-def make_articles_response (res, limit = MAX_RESULTS, lang = LANG):
-    return make_json_response ({
+def make_articles_response (res, limit = MAX_RESULTS, lang = LANG, paged = False):
+    """Build the response envelope for a list of articles.
+
+    If paged is set, a cursor to the next page is included if the page is full.
+
+    """
+    res = list (res)
+    obj = {
         'limit' : limit,
         'data' : [ make_article (row, lang) for row in res ]
-    })
+    }
+    if paged and len (res) >= limit:
+        obj['next'] = encode_cursor ([res[-1][0]])
+    return make_json_response (obj)
 
 
-@app.endpoint ('articles')
+@endpoint ('articles')
+@cached
 def articles ():
     """ Endpoint.  Retrieve a list of articles. """
 
     offset = int (arg ('offset', '0', re_integer_arg))
     limit = clip (arg ('limit', str (MAX_RESULTS), re_integer_arg), 1, MAX_RESULTS)
+    cursor = cursor_arg (ARTICLE_KEYSET_TYPES)
+
+    keyset_where, params = keyset (cursor, ARTICLE_KEYSET)
+    params.update ({ 'offset' : offset, 'limit' : limit })
 
-    with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, r"""
+    with current_app.config.dba.begin () as conn:
+        res = execute (conn, 'articles', r"""
         SELECT no
         FROM article
+        WHERE {keyset}
         ORDER BY no
         LIMIT :limit
         OFFSET :offset
-        """, { 'offset' : offset, 'limit' : limit })
+        """.format (keyset = keyset_where), params)
 
-        return make_articles_response (res, limit)
+        return make_articles_response (res, limit, paged = True)
 
 
-@app.endpoint ('articles_id')
+@endpoint ('articles_id')
+@cached
 def articles_id (_id = None):
     """ Endpoint.  Retrieve an article. """
 
-    with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, r"""
+    with current_app.config.dba.begin () as conn:
+        res = execute (conn, 'article', r"""
         SELECT no
         FROM article
         WHERE no = :id
@@ -312,66 +1149,728 @@ def articles_id (_id = None):
         return make_articles_response (res)
 
 
-@app.endpoint ('articles_id_formats')
+def make_formats (no, webtext):
+    """ Build the list of formats of an article. """
+
+    canonical_url = current_app.config['APPLICATION_MAIN_URL'] + 'search?article_id='
+
+    return [
+        {
+            'mimetype' : 'text/x-html-literal',
+            'lang' : LANG,
+            'embeddable' : True,
+            'text' : normalize_iso ('<div>%s</div>' % webtext),
+        },
+        {
+            'mimetype' : 'text/html',
+            'lang' : LANG,
+            'canonical' : True,
+            'urls' : [ canonical_url + str (no) ],
+        }
+    ]
+
+
+WEBTEXT_SQL = """
+SELECT webtext FROM article WHERE no=:no
+"""
+
+ARTICLE_HEADWORDS_SQL = r"""
+SELECT id, webkeyword, no, sortkeyword, n
+FROM keyword
+WHERE no = :id
+AND {keyset}
+ORDER BY sortkeyword, n, no, id
+LIMIT :limit
+OFFSET :offset
+"""
+
+
+@endpoint ('articles_id_formats')
+@cached
 def articles_id_formats (_id):
     """ Endpoint.  Retrieve an article's available formats. """
 
-    canonical_url = app.config['APPLICATION_MAIN_URL'] + 'search?article_id='
-
-    with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, r"""
-        SELECT webtext FROM article WHERE no=:no
-        """, { 'no' : _id })
-        return make_json_response ([
-            {
-                'mimetype' : 'text/x-html-literal',
-                'lang' : LANG,
-                'embeddable' : True,
-                'text' : normalize_iso ('<div>%s</div>' % res.fetchone ()[0]),
-            },
-            {
-                'mimetype' : 'text/html',
-                'lang' : LANG,
-                'canonical' : True,
-                'urls' : [ canonical_url + str (_id) ],
-            }
-        ])
-
-
-@app.endpoint ('articles_id_headwords')
+    store = current_app.config.formats_store
+    if store is not None:
+        body = store.get (_id)
+        if body is not None:
+            if is_pretty ():
+                return make_json_response (json.loads (body))
+            return make_raw_json_response (body)
+        # not in the store: the article may be newer than the store
+
+    with current_app.config.dba.begin () as conn:
+        res = execute (conn, 'article webtext', WEBTEXT_SQL, { 'no' : _id })
+        row = res.fetchone ()
+        if row is None:
+            flask.abort (404)
+        return make_json_response (make_formats (_id, row[0]))
+
+
+def batched (iterable, size):
+    """ Yield lists of size items. """
+    it = iter (iterable)
+    while True:
+        batch = list (itertools.islice (it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def export_headword_rows (since_id):
+    """ Yield the headwords with id > since_id in wordlist order. """
+
+    hwi = current_app.config.hwi
+    if hwi is not None:
+        return (hwi.row (i) for i in range (len (hwi)) if hwi.ids[i] > since_id)
+
+    return execute_streamed ('export headwords', """
+    SELECT id, webkeyword, no, sortkeyword, n
+    FROM keyword
+    WHERE id > :since
+    ORDER BY sortkeyword, n, no, id
+    """, { 'since' : since_id })
+
+
+@endpoint ('export')
+def export ():
+    """Endpoint.  Stream all headwords and, optionally, all article formats as
+    newline-delimited JSON.
+
+    The rows come straight off a server-side cursor (or the headword index),
+    so memory use does not depend on the size of the dictionary.  The last
+    line holds a token for the since parameter of the next export, which then
+    returns only rows added after this one.
+
+    """
+    with_formats = request.args.get ('formats', '0') not in ('', '0')
+    since_id, since_no = cursor_arg ((int, int), 'since') or [0, 0]
+
+    def generate ():
+        max_id, max_no = since_id, since_no
+        headwords = articles = 0
+
+        for batch in batched (export_headword_rows (since_id), EXPORT_BATCH):
+            objs = make_headwords (batch)
+            for obj in objs:
+                obj['type'] = 'headword'
+            yield b''.join (serialize (obj) + b'\n' for obj in objs)
+            max_id = max (max_id, max (row[0] for row in batch))
+            headwords += len (batch)
+
+        if with_formats:
+            rows = execute_streamed ('export articles', """
+            SELECT no, webtext FROM article WHERE no > :since ORDER BY no
+            """, { 'since' : since_no })
+            for batch in batched (rows, EXPORT_BATCH):
+                yield b''.join (serialize ({
+                    'type'         : 'article',
+                    'articles_url' : 'v1/articles/%d' % row[0],
+                    'formats'      : make_formats (row[0], row[1]),
+                }) + b'\n' for row in batch)
+                max_no = batch[-1][0]
+                articles += len (batch)
+
+        yield serialize ({
+            'type'      : 'end',
+            'headwords' : headwords,
+            'articles'  : articles,
+            'next'      : encode_cursor ([max_id, max_no]),
+        }) + b'\n'
+
+    resp = flask.Response (flask.stream_with_context (generate ()), mimetype='application/x-ndjson')
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+
+@endpoint ('gateway_headwords')
+def gateway_headwords ():
+    """Endpoint.  Search the headwords of all dictionaries known to the gateway.
+
+    Takes the parameters of the headwords endpoint.  Not found unless the
+    gateway is configured.
+
+    """
+    gateway = current_app.config.gateway
+    if gateway is None:
+        flask.abort (404)
+    return make_json_response (gateway.search (request.args.items (multi = True)))
+
+
+def build_formats_store (path):
+    """ Precompute the formats responses of all articles into a store. """
+
+    from formats_store import FormatsStore
+
+    with current_app.config.dba.connect () as conn:
+        res = conn.execution_options (stream_results = True).execute (text (
+            'SELECT no, webtext FROM article ORDER BY no'))
+        return FormatsStore.build (path, (
+            (row[0], serialize (make_formats (row[0], row[1])))
+            for row in res
+        ))
+
+
+@endpoint ('articles_formats')
+@cached
+def articles_formats ():
+    """ Endpoint.  Retrieve the formats of many articles in one request. """
+
+    ids = ids_arg ()
+
+    # the serialized formats by article no
+    formats = {}
+    store = current_app.config.formats_store
+    if store is not None:
+        for no in ids:
+            body = store.get (no)
+            if body is not None:
+                formats[no] = body
+
+    # not in the store: the articles may be newer than the store
+    missing = [no for no in ids if no not in formats]
+    if missing:
+        sql_ids, params = in_list ('no', missing)
+        with current_app.config.dba.begin () as conn:
+            res = execute (conn, 'articles webtext', r"""
+            SELECT no, webtext FROM article WHERE no IN {ids}
+            """.format (ids = sql_ids), params)
+            for row in res:
+                formats[row[0]] = serialize (make_formats (row[0], row[1]))
+
+    ids = [no for no in ids if no in formats]
+    if is_pretty ():
+        return make_json_response ({
+            'limit' : MAX_RESULTS,
+            'data'  : [
+                {
+                    'articles_url' : 'v1/articles/%d' % no,
+                    'formats'      : json.loads (formats[no]),
+                } for no in ids
+            ]
+        })
+
+    # keys in sorted order, same as serialize ()
+    return make_raw_json_response (b'{"data":[%s],"limit":%d}' % (b','.join (
+        b'{"articles_url":"v1/articles/%d","formats":%s}' % (no, formats[no]) for no in ids
+    ), MAX_RESULTS))
+
+
+@endpoint ('articles_id_headwords')
+@cached
 def articles_id_headwords (_id):
     """ Endpoint.  Retrieve the list of headwords for an article. """
 
     offset = int (arg ('offset', '0', re_integer_arg))
     limit = clip (arg ('limit', str (MAX_RESULTS), re_integer_arg), 1, MAX_RESULTS)
+    cursor = cursor_arg (HEADWORD_KEYSET_TYPES)
 
-    with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, r"""
-        SELECT id, webkeyword, no
-        FROM keyword
-        WHERE no = :id
-        ORDER BY sortkeyword
-        LIMIT :limit
-        OFFSET :offset
-        """, { 'id' : _id, 'offset' : offset, 'limit' : limit })
+    keyset_where, params = keyset (cursor, HEADWORD_KEYSET)
+    params.update ({ 'id' : _id, 'offset' : offset, 'limit' : limit })
+
+    res = execute_streamed ('article headwords', ARTICLE_HEADWORDS_SQL.format (keyset = keyset_where), params)
+    return make_headwords_response (res, limit, paged = True)
+
+
+def query_templates (conn):
+    """Return the SQL statements of the endpoints to check with EXPLAIN.
+
+    Returns a list of: name, sql, parameters, problems to ignore.  The
+    parameters are taken from the first headword.
+
+    """
+    row = conn.execute (text ('SELECT id, no, sortkeyword, n FROM keyword LIMIT 1')).fetchone ()
+    if row is None:
+        return []
+    _id, no, sortkeyword, n = row
+    cursor = [sortkeyword, n, no, _id]
+
+    templates = [
+        # walks the index in order and stops at the limit
+        headwords_sql (None, None, 0, MAX_RESULTS, None) + (('full index scan', ), ),
+        ('headwords cursor', ) + headwords_sql (None, None, 0, MAX_RESULTS, cursor)[1:] + ((), ),
+        # sorts the matches of the keyword index
+        headwords_sql ('a*', None, 0, MAX_RESULTS, None) + (('filesort', ), ),
+    ]
+    if current_app.config.dba.has_fulltext:
+        # sorts the matches of the full-text index
+        templates.append (headwords_sql (None, 'a', 0, MAX_RESULTS, None) + (('filesort', ), ))
+
+    keyset_where, params = keyset (None, HEADWORD_KEYSET)
+    params.update ({ 'id' : no, 'offset' : 0, 'limit' : MAX_RESULTS })
+    templates += [
+        # these sort a handful of rows
+        ('headword context', CONTEXT_SQL, { 'id' : _id, 'limit' : 10, 'limit1' : 11 }, ('filesort', )),
+        ('article headwords', ARTICLE_HEADWORDS_SQL.format (keyset = keyset_where), params, ('filesort', )),
+        ('article webtext', WEBTEXT_SQL, { 'no' : no }, ()),
+    ]
+    return templates
+
+
+def check_query_plans (app):
+    """Run EXPLAIN on the SQL statements of the endpoints.
+
+    Logs a warning for every full table or index scan and every filesort, eg.
+    because an index went missing in a reimport.  Returns the number of
+    problems found.
+
+    """
+    problems = 0
+    with app.app_context (), connect (app).connect () as conn:
+        for name, sql, params, ignored in query_templates (conn):
+            try:
+                plan = app.config.dba.explain (conn, sql, params)
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                logger.log (logging.WARNING, 'Query plan: %s: EXPLAIN failed: %s', name, e)
+                problems += 1
+                continue
+            for step, problem in plan:
+                if problem is not None and problem not in ignored:
+                    logger.log (logging.WARNING, 'Query plan: %s: %s: %s', name, problem, step)
+                    problems += 1
+                else:
+                    logger.log (logging.DEBUG, 'Query plan: %s: %s', name, step)
+    return problems
+
+
+def export_sqlite (path):
+    """Export the database into an embedded SQLite file.
+
+    The file can be shipped to the web nodes and served with DATABASE="sqlite".
+
+    """
+
+    path = os.path.expanduser (path)
+    fd, tmp_path = tempfile.mkstemp (dir = os.path.dirname (path),
+                                     prefix = os.path.basename (path) + '.', suffix = '.tmp')
+    os.close (fd)
+    os.chmod (tmp_path, 0o644)
+
+    lite = sqlite3.connect (tmp_path)
+    lite.executescript ("""
+    -- keyword is folded already.  NOCASE matches the case insensitive LIKE,
+    -- so that LIKE can use keyword_keyword.
+    CREATE TABLE keyword (
+      id          INTEGER PRIMARY KEY,
+      keyword     TEXT    NOT NULL COLLATE NOCASE,
+      webkeyword  TEXT    NOT NULL,
+      sortkeyword TEXT    NOT NULL,
+      n           INTEGER NOT NULL,
+      no          INTEGER NOT NULL
+    );
+    CREATE TABLE article (
+      no          INTEGER PRIMARY KEY,
+      webtext     TEXT,
+      idxtext     TEXT
+    );
+    """)
+
+    def batches (res, size = 1000):
+        while True:
+            rows = res.fetchmany (size)
+            if not rows:
+                break
+            yield rows
+
+    with current_app.config.dba.connect () as conn:
+        conn = conn.execution_options (stream_results = True)
+        res = conn.execute (text ('SELECT id, keyword, webkeyword, sortkeyword, n, no FROM keyword'))
+        for rows in batches (res):
+            lite.executemany ('INSERT INTO keyword VALUES (?, ?, ?, ?, ?, ?)', [
+                (r[0], fold (r[1] or ''), r[2] or '', r[3] or '', r[4] or 0, r[5]) for r in rows
+            ])
+        res = conn.execute (text ('SELECT no, webtext, idxtext FROM article'))
+        for rows in batches (res):
+            lite.executemany ('INSERT INTO article VALUES (?, ?, ?)', [tuple (r) for r in rows])
+
+        # SQLite sorts sortkeyword by code point.  Warn if MySQL does not.
+        res = conn.execute (text ('SELECT id FROM keyword ORDER BY sortkeyword, n, no, id'))
+        mysql_order = [r[0] for r in res]
+
+    lite.executescript ("""
+    CREATE INDEX keyword_sortkeyword ON keyword (sortkeyword, n, no, id);
+    CREATE INDEX keyword_no ON keyword (no);
+    CREATE INDEX keyword_keyword ON keyword (keyword);
+    ANALYZE;
+    """)
+    lite.commit ()
+
+    sqlite_order = [r[0] for r in lite.execute ('SELECT id FROM keyword ORDER BY sortkeyword, n, no, id')]
+    if sqlite_order != mysql_order:
+        logger.log (logging.WARNING, 'export_sqlite: the wordlist order differs from MySQL')
+    lite.close ()
+
+    os.replace (tmp_path, path)
+    logger.log (logging.INFO, 'export_sqlite: Exported %d headwords to %s', len (mysql_order), path)
+
+
+@endpoint ('metrics')
+def metrics_ ():
+    """ Endpoint.  The metrics in the Prometheus text format. """
+
+    return flask.Response (current_app.config.metrics.render (),
+                           content_type = metrics.CONTENT_TYPE)
+
+
+@endpoint ('status')
+def status ():
+    """ Endpoint.  Statistics of the database connection pool. """
+
+    return make_json_response ({
+        'pool' : current_app.config.dba.stats.as_dict (),
+    })
+
+
+def make_metrics (app):
+    """ Build the registry of the server metrics. """
+
+    m = metrics.Registry ()
+    m.request_seconds = m.histogram (
+        'cpd_request_duration_seconds', 'Request latency until the last byte was sent.',
+        ('endpoint', 'status'))
+    m.response_bytes = m.histogram (
+        'cpd_response_size_bytes', 'Size of the response body.',
+        ('endpoint', ), metrics.SIZE_BUCKETS)
+    m.sql_seconds = m.histogram (
+        'cpd_sql_duration_seconds', 'Latency of the SQL statements until the first row.',
+        ('endpoint', 'statement'))
+    m.sql_rows = m.histogram (
+        'cpd_sql_rows', 'Rows returned by the SQL statements.',
+        ('endpoint', 'statement'), metrics.ROW_BUCKETS)
+
+    def cache ():
+        cache = app.config.response_cache
+        return [(('hit', ), cache.hits), (('miss', ), cache.misses)]
+
+    def single_flight ():
+        return [((), app.config.single_flight.shared)]
+
+    def admission_running ():
+        return [((cls, ), n) for cls, n in sorted (app.config.concurrency.running.items ())]
+
+    def admission_rejected ():
+        return ([((cls, 'busy'), n) for cls, n in sorted (app.config.concurrency.rejected.items ())] +
+                [((cls, 'rate'), n) for cls, n in sorted (app.config.rate_limits.rejected.items ())])
+
+    def pool ():
+        if app.config.dba is None:
+            return []
+        return [((name, ), value) for name, value in sorted (app.config.dba.stats.as_dict ().items ())]
+
+    m.callback ('cpd_response_cache_lookups_total', 'Lookups in the response cache.',
+                ('result', ), cache, type = 'counter')
+    m.callback ('cpd_single_flight_shared_total', 'Requests answered by a concurrent identical request.',
+                (), single_flight, type = 'counter')
+    m.callback ('cpd_admission_running', 'Requests running per cost class.',
+                ('class', ), admission_running)
+    m.callback ('cpd_admission_rejected_total', 'Requests rejected per cost class and reason.',
+                ('class', 'reason'), admission_rejected, type = 'counter')
+    m.callback ('cpd_db_pool', 'Statistics of the database connection pool.  See: /v1/status',
+                ('stat', ), pool)
+    return m
+
+
+def record_request (endpoint, status, seconds, size):
+    """ Record the latency and size of a response. """
+    m = current_app.config.metrics
+    endpoint = endpoint or ''
+    m.request_seconds.observe (seconds, endpoint, str (status))
+    m.response_bytes.observe (size, endpoint)
+
+
+def query_class ():
+    """Return the cost class of the current request for the admission control.
+
+    Returns 'lookup', 'search', 'fulltext', 'export' or None if the request is
+    never limited.
+
+    """
+    endpoint = request.endpoint
+    if endpoint in (None, 'metrics', 'status'):
+        return None
+    if endpoint == 'export':
+        return 'export'
+    if request.args.get ('fulltext'):
+        return 'fulltext'
+    if endpoint in ('headwords', 'headwords_suggest', 'gateway_headwords') and 'ids' not in request.args:
+        return 'search'
+    return 'lookup'
+
+
+def client_address ():
+    """ The address of the client, for the rate limits. """
+    header = current_app.config.get ('CLIENT_ADDRESS_HEADER')
+    if header and header in request.headers:
+        # eg. X-Forwarded-For: client, proxy1, proxy2
+        return request.headers[header].split (',')[0].strip ()
+    return request.remote_addr
+
+
+def admit ():
+    """Admit the current request to its class or abort.
+
+    Aborts with 429 Too Many Requests if the client exceeded the rate limit of
+    the class and with 503 Service Unavailable if the class is busy.
+
+    """
+    cls = query_class ()
+    if cls is None:
+        return
+    config = current_app.config
+
+    # the ASGI app may have taken the token before passing the request on
+    if not request.environ.get ('cpd.rate_limited'):
+        request.environ['cpd.rate_limited'] = True
+        wait = config.rate_limits.take (cls, client_address ())
+        if wait > 0:
+            raise TooManyRequests ('Too many %s requests' % cls,
+                                   retry_after = admission.retry_after (wait))
+    if not config.concurrency.acquire (cls):
+        raise ServiceUnavailable ('Too many %s requests running' % cls,
+                                  retry_after = config.get ('ADMISSION_RETRY_AFTER', 1))
+    flask.g.admitted = cls
+
+
+def release (exc = None):
+    """Release the class of the current request.
+
+    Usually after_request does this.  This is for requests that did not get
+    that far.
+
+    """
+    current_app.config.concurrency.release (flask.g.pop ('admitted', None))
+
+
+def before_request ():
+    flask.g.start_time = time.monotonic ()
+    app = current_app._get_current_object ()
+    if not app.config.started:
+        startup (app)
+    admit ()
+
+
+def after_request (resp):
+    """Compress the response, record the request metrics and release the
+    class of the request.
+
+    Streamed responses are recorded and released when the last chunk has been
+    sent.
+
+    """
+    resp = compress_response (resp)
+    start_time = flask.g.start_time
+    endpoint = request.endpoint
+    app_ = current_app._get_current_object ()
+    # the request context ends before a streamed response is sent
+    admitted = flask.g.pop ('admitted', None)
+
+    if not resp.is_streamed:
+        record_request (endpoint, resp.status_code, time.monotonic () - start_time,
+                        resp.content_length or 0)
+        app_.config.concurrency.release (admitted)
+        return resp
+
+    status = resp.status_code
+
+    def done (size):
+        # no reference to resp here, or the cycle delays closing the stream
+        with app_.app_context ():
+            record_request (endpoint, status, time.monotonic () - start_time, size)
+        app_.config.concurrency.release (admitted)
+
+    resp.response = CountingIterable (resp.response, done)
+    return resp
+
+
+class CountingIterable (object):
+    """Count the bytes of a streamed response.
+
+    Calls done (size) once, after the last chunk or when the server closes the
+    response.  Closes the wrapped iterable even if it was never iterated, so
+    that a stream_with_context generator releases its request context.
+
+    """
+
+    def __init__ (self, chunks, done):
+        self.chunks = chunks
+        self.done   = done
+        self.size   = 0
 
-        return make_headwords_response (res, limit)
+
+    def __iter__ (self):
+        for chunk in self.chunks:
+            self.size += len (chunk)
+            yield chunk
+        self.finish ()
+
+
+    def finish (self):
+        if self.done is not None:
+            done, self.done = self.done, None
+            done (self.size)
+
+
+    def close (self):
+        if hasattr (self.chunks, 'close'):
+            self.chunks.close ()
+        self.finish ()
+
+
+def after_fork (app):
+    """ Drop the connections a worker process must not share with the master. """
+    app.config.dba.engine.dispose (close = False)
+    if app.config.formats_store is not None:
+        app.config.formats_store.reset ()
+    if app.config.gateway is not None:
+        app.config.gateway.reset ()
+    app.config.slow_queries   = queue.Queue (100)
+    app.config.explain_thread = None
+
+
+def make_url_map ():
+    return Map ([
+        Rule ('/v1',                              endpoint = 'info'),
+        Rule ('/v1/headwords',                    endpoint = 'headwords'),
+        Rule ('/v1/headwords/suggest',            endpoint = 'headwords_suggest'),
+        Rule ('/v1/headwords/<int:_id>',          endpoint = 'headwords_id'),
+        Rule ('/v1/headwords/<int:_id>/context',  endpoint = 'headwords_id_context'),
+        Rule ('/v1/articles',                     endpoint = 'articles'),
+        Rule ('/v1/articles/formats',             endpoint = 'articles_formats'),
+        Rule ('/v1/articles/<int:_id>',           endpoint = 'articles_id'),
+        Rule ('/v1/articles/<int:_id>/formats',   endpoint = 'articles_id_formats'),
+        Rule ('/v1/articles/<int:_id>/headwords', endpoint = 'articles_id_headwords'),
+        Rule ('/v1/export',                       endpoint = 'export'),
+        Rule ('/v1/gateway/headwords',            endpoint = 'gateway_headwords'),
+        Rule ('/v1/status',                       endpoint = 'status'),
+        Rule ('/v1/metrics',                      endpoint = 'metrics'),
+    ])
+
+
+def create_app (config_files = (), **config):
+    """Create the application.
+
+    Reads the config files in order, then config.  Does not connect to the
+    database nor load anything: that is done by startup (), which runs before
+    the first request unless called earlier, eg. by the pre-fork master.
+
+    """
+    app = flask.Flask (__name__)
+    for config_file in config_files:
+        app.config.from_pyfile (config_file)
+    app.config.update (config)
+
+    app.url_map = make_url_map ()
+    app.view_functions.update (VIEWS)
+    app.before_request (before_request)
+    app.after_request (after_request)
+    app.teardown_request (release)
+
+    start_time = datetime.datetime.now ()
+    app.config['server_start_time'] = str (int (start_time.timestamp ()))
+    app.config['server_start_datetime'] = start_time.astimezone (datetime.timezone.utc)
+
+    app.config.dba            = None
+    app.config.fulltext_index = None
+    app.config.formats_store  = None
+    app.config.hwi            = None
+    app.config.gateway        = None
+    app.config.metrics        = make_metrics (app)
+    app.config.response_cache = LRUCache (app.config.get ('RESPONSE_CACHE_SIZE', 1000),
+                                          app.config.get ('RESPONSE_CACHE_TTL', 3600))
+    app.config.single_flight  = SingleFlight ()
+    app.config.query_plans    = LRUCache (100, 600)
+    app.config.slow_queries   = queue.Queue (100)
+    app.config.explain_thread = None
+    app.config.explain_lock   = threading.Lock ()
+    app.config.concurrency    = admission.ConcurrencyLimiter (app.config.get ('CONCURRENCY_LIMITS', {}))
+    app.config.rate_limits    = admission.TokenBuckets (app.config.get ('RATE_LIMITS', {}))
+    app.config.started        = False
+    app.config.startup_lock   = threading.Lock ()
+    return app
+
+
+def connect (app):
+    """ Create the database engine.  It connects on first use. """
+    if app.config.dba is None:
+        app.config.dba = ENGINES[app.config.get ('DATABASE', 'mysql')] (**app.config)
+    return app.config.dba
+
+
+def startup (app, shared = False):
+    """Create the database engine, load the indexes and open the stores.
+
+    Runs only once.  If shared is set, the headword index is memory-mapped, so
+    that forked worker processes share it.
+
+    """
+    with app.config.startup_lock:
+        if app.config.started:
+            return
+        connect (app)
+
+        if app.config.get ('CHECK_QUERY_PLANS', True):
+            check_query_plans (app)
+
+        backend = app.config.get ('FULLTEXT_BACKEND', 'mysql')
+        if backend != 'mysql':
+            import fulltext as fulltext_backends
+            with app.config.dba.begin () as conn:
+                app.config.fulltext_index = fulltext_backends.BACKENDS[backend].from_db (conn)
+
+        if app.config.get ('FORMATS_STORE'):
+            from formats_store import FormatsStore
+            app.config.formats_store = FormatsStore (app.config['FORMATS_STORE'])
+
+        if app.config.get ('HEADWORD_INDEX', True):
+            app.config.hwi = load_headword_index (app, shared)
+        elif app.config.fulltext_index is not None:
+            # mapping thousands of article nos to headwords in SQL would need
+            # one bind parameter per no
+            logger.log (logging.INFO, 'HeadwordIndex: loaded for FULLTEXT_BACKEND=%r', backend)
+            app.config.hwi = load_headword_index (app, shared)
+
+        if app.config.get ('GATEWAY_BACKENDS'):
+            from gateway import Gateway
+            app.config.gateway = Gateway.from_config (app.config)
+
+        app.config.started = True
+
+
+def load_headword_index (app, shared = False, rebuild = False):
+    """Load the headword index.
+
+    Maps HEADWORD_INDEX_FILE if configured and not rebuild, else builds the
+    index from the database and saves it to HEADWORD_INDEX_FILE if configured.
+    A file in an older format is rebuilt.
+
+    """
+    index_file = app.config.get ('HEADWORD_INDEX_FILE')
+    if index_file and os.path.exists (os.path.expanduser (index_file)) and not rebuild:
+        try:
+            return HeadwordIndex.load (index_file)
+        except ValueError as e:
+            # eg. saved by an older version
+            logger.log (logging.WARNING, 'HeadwordIndex: %s, rebuilding', e)
+
+    with connect (app).begin () as conn:
+        hwi = HeadwordIndex.from_db (conn, normalize_headword)
+    if index_file:
+        hwi.save (index_file)
+        return HeadwordIndex.load (index_file)
+    if shared:
+        # map one copy into all workers
+        fd, tmp_path = tempfile.mkstemp (prefix = 'cpd-headwords-')
+        os.close (fd)
+        hwi.save (tmp_path)
+        hwi = HeadwordIndex.load (tmp_path)
+        os.remove (tmp_path)
+    return hwi
 
 
 #
 # main
 #
 
-parser = argparse.ArgumentParser (description='A simple API for dictionares')
-
-parser.add_argument ('-v', '--verbose', dest='verbose', action='count',
-                     help='increase output verbosity', default=0)
-parser.add_argument ('-c', '--config-file', dest='config_file', action='append',
-                     required=True, metavar='CONFIG_FILE',
-                     help="a config file (repeat for more than one, later ones overwrite)")
-
-args = parser.parse_args ()
-args.start_time = datetime.datetime.now ()
 LOG_LEVELS = {
     0: logging.CRITICAL,
     1: logging.ERROR,
@@ -379,53 +1878,98 @@ LOG_LEVELS = {
     3: logging.INFO,
     4: logging.DEBUG
 }
-args.log_level = LOG_LEVELS.get (args.verbose + 1, logging.CRITICAL)
-
-logging.basicConfig (format = '%(asctime)s - %(levelname)s - %(message)s')
-logging.getLogger ('sqlalchemy.engine').setLevel (args.log_level)
-logging.getLogger ('server').setLevel (args.log_level)
 
-logger = logging.getLogger ('server')
-
-for config_file in args.config_file:
-    app.config.from_pyfile (config_file)
 
-app.config.dba = MySQLEngine (**app.config)
-app.config['SQLALCHEMY_DATABASE_URI'] = app.config.dba.url
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['server_start_time'] = str (int (args.start_time.timestamp ()))
+def build_parser ():
+    parser = argparse.ArgumentParser (description='A simple API for dictionares')
 
-app.url_map = Map ([
-    Rule ('/v1',                              endpoint = 'info'),
-    Rule ('/v1/headwords',                    endpoint = 'headwords'),
-    Rule ('/v1/headwords/<int:_id>',          endpoint = 'headwords_id'),
-    Rule ('/v1/headwords/<int:_id>/context',  endpoint = 'headwords_id_context'),
-    Rule ('/v1/articles',                     endpoint = 'articles'),
-    Rule ('/v1/articles/<int:_id>',           endpoint = 'articles_id'),
-    Rule ('/v1/articles/<int:_id>/formats',   endpoint = 'articles_id_formats'),
-    Rule ('/v1/articles/<int:_id>/headwords', endpoint = 'articles_id_headwords'),
-])
+    parser.add_argument ('-v', '--verbose', dest='verbose', action='count',
+                         help='increase output verbosity', default=0)
+    parser.add_argument ('-c', '--config-file', dest='config_file', action='append',
+                         required=True, metavar='CONFIG_FILE',
+                         help="a config file (repeat for more than one, later ones overwrite)")
+    return parser
 
-dba = flask_sqlalchemy.SQLAlchemy ()
-dba.init_app (app)
 
-port = app.config.get ('APPLICATION_PORT', 5000)
-path = app.config.get ('APPLICATION_ROOT', '')
+def configure_logging (args):
+    args.log_level = LOG_LEVELS.get (args.verbose + 1, logging.CRITICAL)
 
-logger.log (logging.INFO, "'{name}' is now served from localhost:{port}{path}/v1".format (
-    name = app.config['APPLICATION_NAME'],
-    port = port,
-    path = path))
+    logging.basicConfig (format = '%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger ('sqlalchemy.engine').setLevel (args.log_level)
+    logging.getLogger ('server').setLevel (args.log_level)
 
 
-if __name__ == "__main__":
+def main ():
     from werkzeug.serving import run_simple
 
-    if path == '':
-        run_simple ('localhost', port, app)
-    else:
+    parser = build_parser ()
+    parser.add_argument ('--build-formats-store', dest='build_formats_store', action='store_true',
+                         help="precompute the article formats into FORMATS_STORE and exit")
+    parser.add_argument ('--export-sqlite', dest='export_sqlite', metavar='SQLITE_FILE',
+                         help="export the database into an SQLite file and exit")
+    parser.add_argument ('--build-headword-index', dest='build_headword_index', action='store_true',
+                         help="rebuild the headword index into HEADWORD_INDEX_FILE and exit")
+    parser.add_argument ('--check-query-plans', dest='check_query_plans', action='store_true',
+                         help="warn about full scans and filesorts in the query plans and exit")
+    parser.add_argument ('-w', '--workers', dest='workers', type=int, default=1,
+                         help="serve with this many pre-forked worker processes (default: 1)")
+
+    args = parser.parse_args ()
+    configure_logging (args)
+
+    app = create_app (args.config_file)
+
+    if args.build_formats_store:
+        if not app.config.get ('FORMATS_STORE'):
+            parser.error ('FORMATS_STORE is not configured')
+        connect (app)
+        with app.app_context ():
+            build_formats_store (app.config['FORMATS_STORE'])
+        return
+
+    if args.export_sqlite:
+        connect (app)
+        with app.app_context ():
+            export_sqlite (args.export_sqlite)
+        return
+
+    if args.build_headword_index:
+        if not app.config.get ('HEADWORD_INDEX_FILE'):
+            parser.error ('HEADWORD_INDEX_FILE is not configured')
+        load_headword_index (app, rebuild = True)
+        return
+
+    if args.check_query_plans:
+        problems = check_query_plans (app)
+        logger.log (logging.INFO, 'Query plans: %d problems', problems)
+        sys.exit (1 if problems else 0)
+
+    port = app.config.get ('APPLICATION_PORT', 5000)
+    path = app.config.get ('APPLICATION_ROOT', '')
+
+    application = app
+    if path != '':
         from werkzeug.wsgi import DispatcherMiddleware
         application = DispatcherMiddleware (flask.Flask ('dummy_app_for_root'), {
             app.config['APPLICATION_ROOT'] : app,
         })
+
+    logger.log (logging.INFO, "'{name}' is now served from localhost:{port}{path}/v1".format (
+        name = app.config['APPLICATION_NAME'],
+        port = port,
+        path = path))
+
+    if args.workers > 1:
+        from werkzeug.serving import make_server
+        import prefork
+
+        # load everything once in the master, the workers inherit it
+        startup (app, shared = True)
+        prefork.serve (make_server ('localhost', port, application), args.workers,
+                       functools.partial (after_fork, app))
+    else:
         run_simple ('localhost', port, application)
+
+
+if __name__ == "__main__":
+    main ()
@@ -0,0 +1,149 @@
+# -*- encoding: utf-8 -*-
+
+"""Transliteration of queries into ISO 15919
+
+Converts the `q` and `fulltext` parameters from the transliterations supported
+for queries into ISO 15919, the transliteration of the CPD.  The glob
+characters '*' and '?' pass through unchanged.
+
+"""
+
+import functools
+import re
+
+
+ISO      = 'x-iso'
+IAST     = 'x-iast'
+VELTHUIS = 'x-velthuis'
+DEVA     = 'x-deva'
+
+SUPPORTED = (ISO, IAST, VELTHUIS, DEVA)
+""" The transliterations supported for queries, in order of preference. """
+
+
+# IAST differs from ISO 15919 only in a few characters.  ḷ stays: in Pāli it
+# is the retroflex lateral, not the vocalic l.
+iast_trans = str.maketrans ({
+    'ṃ' : 'ṁ',
+    'ṛ' : 'r̥',
+    'ṝ' : 'r̥̄',
+    'ḹ' : 'l̥̄',
+    'Ṃ' : 'Ṁ',
+    'Ṛ' : 'R̥',
+    'Ṝ' : 'R̥̄',
+    'Ḹ' : 'L̥̄',
+})
+
+velthuis_table = {
+    'aa'  : 'ā',
+    'ii'  : 'ī',
+    'uu'  : 'ū',
+    '.rr' : 'r̥̄',
+    '.r'  : 'r̥',
+    '.ll' : 'l̥̄',
+    '.l'  : 'ḷ',
+    '"n'  : 'ṅ',
+    '~n'  : 'ñ',
+    '.t'  : 'ṭ',
+    '.d'  : 'ḍ',
+    '.n'  : 'ṇ',
+    '"s'  : 'ś',
+    '.s'  : 'ṣ',
+    '.m'  : 'ṁ',
+    '.h'  : 'ḥ',
+    '~'   : 'm̐',
+    '.a'  : '’',
+}
+
+# longest match first
+re_velthuis = re.compile ('|'.join (
+    re.escape (k) for k in sorted (velthuis_table, key = len, reverse = True)))
+
+deva_vowels = dict (zip (
+    'अ आ इ ई उ ऊ ऋ ॠ ऌ ॡ ए ऐ ओ औ'.split (),
+    'a ā i ī u ū r̥ r̥̄ l̥ l̥̄ e ai o au'.split ()))
+
+deva_vowel_signs = dict (zip (
+    'ा ि ी ु ू ृ ॄ ॢ ॣ े ै ो ौ'.split (),
+    'ā i ī u ū r̥ r̥̄ l̥ l̥̄ e ai o au'.split ()))
+
+deva_consonants = dict (zip (
+    'क ख ग घ ङ च छ ज झ ञ ट ठ ड ढ ण त थ द ध न प फ ब भ म य र ल ळ व श ष स ह'.split (),
+    'k kh g gh ṅ c ch j jh ñ ṭ ṭh ḍ ḍh ṇ t th d dh n p ph b bh m y r l ḷ v ś ṣ s h'.split ()))
+
+deva_other = {
+    'ं' : 'ṁ',
+    'ः' : 'ḥ',
+    'ँ' : 'm̐',
+    'ऽ' : '’',
+    '।' : '.',
+    '॥' : '.',
+}
+deva_other.update (zip ('०१२३४५६७८९', '0123456789'))
+
+VIRAMA = '्'
+
+
+def parse_lang (lang):
+    """Extract the transliteration from a language tag.
+
+    Eg. 'pi-Latn-x-iast' -> 'x-iast', 'pi-Deva' -> 'x-deva'.  Returns None
+    if the tag names no transliteration.
+
+    """
+    tags = lang.split ('-')
+    if 'x' in tags[:-1]:
+        return 'x-' + tags[tags.index ('x') + 1].lower ()
+    if 'Deva' in tags:
+        return DEVA
+    return None
+
+
+def iast_to_iso (text):
+    return text.translate (iast_trans)
+
+
+def velthuis_to_iso (text):
+    return re_velthuis.sub (lambda m: velthuis_table[m.group (0)], text)
+
+
+def deva_to_iso (text):
+    result = []
+    pending_a = False  # a consonant waiting for its vowel
+    for c in text:
+        if c in deva_vowel_signs or c == VIRAMA:
+            if pending_a:
+                result.append (deva_vowel_signs.get (c, ''))
+                pending_a = False
+            continue
+        if pending_a:
+            result.append ('a')
+            pending_a = False
+        if c in deva_consonants:
+            result.append (deva_consonants[c])
+            pending_a = True
+        elif c in deva_vowels:
+            result.append (deva_vowels[c])
+        else:
+            result.append (deva_other.get (c, c))
+    if pending_a:
+        result.append ('a')
+    return ''.join (result)
+
+
+converters = {
+    ISO      : lambda text: text,
+    IAST     : iast_to_iso,
+    VELTHUIS : velthuis_to_iso,
+    DEVA     : deva_to_iso,
+}
+
+
+@functools.lru_cache (maxsize = 4096)
+def to_iso (text, t13n):
+    """Convert text from the transliteration t13n into ISO 15919.
+
+    Raises KeyError if t13n is not supported.
+
+    """
+    return converters[t13n] (text)